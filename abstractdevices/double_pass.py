@@ -18,14 +18,36 @@ timeout = 20
 
 from labrad.server import LabradServer, setting, Signal
 from twisted.internet.defer import inlineCallbacks, returnValue
+import numpy
 
 SIGNALID = 19811
 
+class CalibrationTable(object):
+    """
+    Calibrated amplitude for the given frequency, the cubic spline through the calibration is sampled once onto a dense
+    evenly spaced table. A lookup computes the index of the nearest entries and interpolates linearly between them,
+    it works on a single frequency or on an array of frequencies.
+    """
+    def __init__(self, frequencies, amplitudes, points = 10001):
+        from scipy.interpolate import interp1d
+        self.domain = (frequencies.min(), frequencies.max())
+        grid = numpy.linspace(self.domain[0], self.domain[1], points)
+        self.step = grid[1] - grid[0]
+        self.table = interp1d(frequencies, amplitudes, kind = 'cubic')(grid)
+    
+    def __call__(self, freq):
+        position = (numpy.asarray(freq, dtype = numpy.float64) - self.domain[0]) / self.step
+        index = numpy.clip(position.astype(numpy.int64), 0, len(self.table) - 2)
+        fraction = position - index
+        ampl = self.table[index] * (1 - fraction) + self.table[index + 1] * fraction
+        return ampl if ampl.ndim else float(ampl)
+
 class doublePass(object):
     """when subclassing need to implement:
         self.freqFunc #function for setting the frequency in MHZ
         self.amplFunc #function for setting the amplitude in DM
         self.outputFunc #function for setting the output using True/False
+    optionally self.freqAmplFunc for setting the frequency and the amplitude together
     """
     def __init__(self, name):
         self.name = name
@@ -71,14 +93,31 @@ class doublePass(object):
             self.outp = output
         returnValue( self.outp)
 
+    @inlineCallbacks
+    def freqAmplFunc(self, freq, ampl):
+        yield self.freqFunc(freq)
+        yield self.amplFunc(ampl)
+    
     @inlineCallbacks
     def frequencyCalibPower(self, freq):
         if not self.calibDomain[0] <= freq <= self.calibDomain[1]: raise Exception ("Frequency out of range")
-        yield self.frequency(freq)
+        if not self.freqRange[0] <= freq <= self.freqRange[1]: raise Exception ("Frequency out of range")
         calibAmpl = self.freqToCalibAmpl(freq) + self.amplOffset
-        yield self.amplitude(calibAmpl) 
+        if not self.amplRange[0] <= calibAmpl <= self.amplRange[1]: raise Exception ("Amplitude out of range")
+        yield self.freqAmplFunc(freq, calibAmpl)
+        self.freq = freq
+        self.ampl = calibAmpl
         returnValue ((self.freq, self.ampl))
     
+    def calibratedAmplitudes(self, freqs):
+        '''returns the calibrated amplitudes for the array of frequencies without setting them'''
+        freqs = numpy.asarray(freqs, dtype = numpy.float64)
+        if ((freqs < self.calibDomain[0]) | (freqs > self.calibDomain[1])).any(): raise Exception ("Frequency out of range")
+        ampls = numpy.asarray(self.freqToCalibAmpl(freqs), dtype = numpy.float64) + self.amplOffset
+        ampls = ampls + numpy.zeros(freqs.shape)
+        if ((ampls < self.amplRange[0]) | (ampls > self.amplRange[1])).any(): raise Exception ("Amplitude out of range")
+        return ampls
+    
     @inlineCallbacks
     def amplitudeOffset(self, offset):
         self.amplOffset = offset
@@ -117,18 +156,23 @@ class DP110(doublePass):
         outp = yield self.server.output(outp, context = self.context)
         returnValue(outp)    
     
+    @inlineCallbacks
+    def freqAmplFunc(self, freq, ampl):
+        p = self.server.packet(context = self.context)
+        p.frequency(freq)
+        p.amplitude(ampl)
+        yield p.send()
+    
     @inlineCallbacks
     def setupCalibration(self, cxn, context):
-        from scipy.interpolate import interp1d
         dv = cxn.data_vault
         dir = yield dv.cd(context = context)
         yield dv.cd(['','Calibrations','Double Pass radial'], context = context)
         yield dv.open(34, context = context)
         calibration = yield dv.get(context = context)
         calibration = calibration.asarray
-        domain = calibration[:,0]
-        self.calibDomain = (domain.min(), domain.max())
-        func = interp1d(calibration[:,0],calibration[:,1],kind = 'cubic')
+        func = CalibrationTable(calibration[:,0],calibration[:,1])
+        self.calibDomain = func.domain
         returnValue(func)
     
     #no calibration, that is no amplitude dependence on frequency
@@ -256,6 +300,7 @@ class Synthesizers( LabradServer ):
 
     @setting(3, "Frequency Calibrated Amplitude", freq = 'v', returns = '(vv)')
     def freqCalibPower(self, c, freq):
+        """Sets the frequency together with the calibrated amplitude, returns the set frequency and amplitude"""
         dp = self.getDP(c)
         (setfreq, setamplitude) = yield dp.frequencyCalibPower(freq)
         self.notifyOtherListeners(c, (dp.name,'frequency',setfreq))
@@ -305,6 +350,12 @@ class Synthesizers( LabradServer ):
         dp = self.getDP(c)
         return dp.deviceID
     
+    @setting(10, "Calibrated Amplitudes", freqs = '*v', returns = '*v')
+    def calibratedAmplitudes(self, c, freqs):
+        """Returns the calibrated amplitudes, including the amplitude offset, for a list of frequencies without setting them"""
+        dp = self.getDP(c)
+        return dp.calibratedAmplitudes(freqs)
+    
     def getDP(self, context):
         if not 'doublePass' in context.keys(): raise Exception ('Double Pass not selected')
         return context['doublePass']
@@ -17,18 +17,21 @@ timeout = 20
 """
 from labrad.server import LabradServer, setting, Signal
 from labrad.units import WithUnit
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, DeferredList, FirstError
 from numpy import linalg as LA
 import numpy as np
 from numpy import cos, sin, sqrt
+from lattice.abstractdevices.registrycache import RegistryCache
 
 SIGNALID = 66060
+REGISTRYID = 66061
 
 class Electrode_Diagonalization( LabradServer ):
 
     name = 'Electrode Diagonalization'
     on_new_value = Signal(SIGNALID, 'signal: new value', '(sv)')
     
+    @inlineCallbacks
     def initServer( self ):
         self.parameters = {}.fromkeys(['endcap_angle','xz_angle','m0','m2'])
         self.voltages = {}.fromkeys(['C1','C2','D1','D2'])
@@ -36,33 +39,41 @@ class Electrode_Diagonalization( LabradServer ):
         self.voltage_range_comp = None,None
         self.voltage_range_dac = None,None
         self.voltage_priority = True
+        self.matrix_key = None
+        self.matrix_cache = None
         self.listeners = set()
-        self.load_params_from_registry()
-        self.intialize_connections()
+        self.registry = RegistryCache(self.client, ['','Servers','Electrode Diagonalization'], REGISTRYID, self.registry_changed)
+        yield self.load_params_from_registry()
+        yield self.intialize_connections()
     
     @inlineCallbacks
     def load_params_from_registry(self):
         '''
         load the matrix parameters from registry
         '''
-        reg = self.client.registry
-        yield reg.cd(['','Servers','Electrode Diagonalization'])
+        yield self.registry.load()
         for param in self.parameters:
-            self.parameters[param] = yield reg.get(param)
+            self.parameters[param] = self.registry.get(param)
         print self.parameters
     
     @inlineCallbacks
+    def registry_changed(self, param, value):
+        '''
+        applies a matrix parameter changed in the registry by another client
+        '''
+        if param not in self.parameters or value == self.parameters[param]: return
+        yield self.set_parameter(param, value)
+        self.notifyAllListeners((param, value['deg'] if param in ['xz_angle','endcap_angle'] else value), self.on_new_value)
+    
     def save_params_to_registry(self):
         '''
-        save the matrix parameters to registry
+        save the matrix parameters to registry, the changes are written together shortly after
         '''
-        reg = self.client.registry
-        yield reg.cd(['','Servers','Electrode Diagonalization'])
         for param, value in self.parameters.iteritems():
             if param in ['comp_angle','endcap_angle']:
-                yield reg.set(param, value.inUnitsOf('deg'))
+                self.registry.set(param, value.inUnitsOf('deg'))
             else:
-                yield reg.set(param, value)
+                self.registry.set(param, value)
     
     @inlineCallbacks
     def intialize_connections(self):
@@ -89,13 +100,13 @@ class Electrode_Diagonalization( LabradServer ):
     
     @inlineCallbacks
     def get_comp_voltages(self):
-        for electrode in ['C1','C2']:
-            self.voltages[electrode] = yield self.do_get_voltage(electrode)
+        voltages = yield self.gather([self.do_get_voltage(electrode) for electrode in ['C1','C2']])
+        self.voltages.update(zip(['C1','C2'], voltages))
     
     @inlineCallbacks
     def get_dac_voltages(self):
-        for electrode in ['D1','D2']:
-            self.voltages[electrode] = yield self.do_get_voltage(electrode)
+        voltages = yield self.gather([self.do_get_voltage(electrode) for electrode in ['D1','D2']])
+        self.voltages.update(zip(['D1','D2'], voltages))
     
     @inlineCallbacks
     def get_comp_range(self):
@@ -111,20 +122,7 @@ class Electrode_Diagonalization( LabradServer ):
         Set or get the compensation angle
         '''
         if angle is not None:
-            self.parameters['xz_angle'] = angle
-            if self.voltage_priority:
-                new_fields = self.calculate_fields()
-                self.fields.update(new_fields)
-                self.on_new_fields()
-            else:
-                new_voltages = self.calculate_voltages()
-                #check range first, if this raises error we stop
-                for electrode, voltage in new_voltages.iteritems():
-                    self.check_range(electrode, voltage)
-                self.voltages.update(new_voltages)
-                for electrode, voltage in self.voltages.iteritems():
-                    yield self.do_set_voltage(electrode, voltage)
-                self.on_new_voltages()
+            yield self.set_parameter('xz_angle', angle)
             self.notifyOtherListeners(c, ('xz_angle',angle['deg']), self.on_new_value)
         returnValue(self.parameters['xz_angle'])
 
@@ -134,63 +132,46 @@ class Electrode_Diagonalization( LabradServer ):
         Set or get the endcap angle
         '''
         if angle is not None:
-            self.parameters['endcap_angle'] = angle
-            if self.voltage_priority:
-                new_fields = self.calculate_fields()
-                self.fields.update(new_fields)
-                self.on_new_fields()
-            else:
-                new_voltages = self.calculate_voltages()
-                #check range first, if this raises error we stop
-                for electrode, voltage in new_voltages.iteritems():
-                    self.check_range(electrode, voltage)
-                self.voltages.update(new_voltages)
-                for electrode, voltage in self.voltages.iteritems():
-                    yield self.do_set_voltage(electrode, voltage)
-                self.on_new_voltages()
+            yield self.set_parameter('endcap_angle', angle)
             self.notifyOtherListeners(c, ('endcap_angle',angle['deg']), self.on_new_value)
         returnValue(self.parameters['endcap_angle'])
     
     @setting(11, "slope m0", value = 'v', returns='v')
     def m0(self, c, value = None):
         if value is not None:
-            self.parameters['m0'] = value
-            if self.voltage_priority:
-                new_fields = self.calculate_fields()
-                self.fields.update(new_fields)
-                self.on_new_fields()
-            else:
-                new_voltages = self.calculate_voltages()
-                #check range first, if this raises error we stop
-                for electrode, voltage in new_voltages.iteritems():
-                    self.check_range(electrode, voltage)
-                self.voltages.update(new_voltages)
-                for electrode, voltage in self.voltages.iteritems():
-                    yield self.do_set_voltage(electrode, voltage)
-                self.on_new_voltages()
+            yield self.set_parameter('m0', value)
             self.notifyOtherListeners(c, ('m0', value), self.on_new_value)
         returnValue(self.parameters['m0'])
     
     @setting(12, "slope m2", value = 'v', returns='v')
     def m1(self, c, value = None):
         if value is not None:
-            self.parameters['m2'] = value
-            if self.voltage_priority:
-                new_fields = self.calculate_fields()
-                self.fields.update(new_fields)
-                self.on_new_fields()
-            else:
-                new_voltages = self.calculate_voltages()
-                #check range first, if this raises error we stop
-                for electrode, voltage in new_voltages.iteritems():
-                    self.check_range(electrode, voltage)
-                self.voltages.update(new_voltages)
-                for electrode, voltage in self.voltages.iteritems():
-                    yield self.do_set_voltage(electrode, voltage)
-                self.on_new_voltages()
+            yield self.set_parameter('m2', value)
             self.notifyOtherListeners(c, ('m2', value), self.on_new_value)
         returnValue(self.parameters['m2'])
     
+    @inlineCallbacks
+    def set_parameter(self, param, value):
+        '''
+        changes one of the matrix parameters, then recalculates the fields or sets the new voltages depending on the priority.
+        the parameter is only changed and saved once the new voltages are set.
+        '''
+        parameters = self.parameters.copy()
+        parameters[param] = value
+        if self.voltage_priority:
+            self.parameters = parameters
+            self.save_params_to_registry()
+            new_fields = self.calculate_fields()
+            self.fields.update(new_fields)
+            self.on_new_fields()
+        else:
+            new_voltages = self.calculate_voltages(parameters = parameters)
+            yield self.do_set_voltages(new_voltages)
+            self.parameters = parameters
+            self.save_params_to_registry()
+            self.voltages.update(new_voltages)
+            self.on_new_voltages()
+    
     @setting(2, "Voltage priority", voltage_priority='b')
     def voltage_priority(self, c, voltage_priority = None):
         '''
@@ -222,18 +203,30 @@ class Electrode_Diagonalization( LabradServer ):
         if fieldname not in self.fields:
             raise Exception('Wrong field name')
         if field is not None:
-            self.fields[fieldname] = field
-            new_voltages = self.calculate_voltages()
-            #check range first, if this raises error we stop
-            for electrode, voltage in new_voltages.iteritems():
-                self.check_range(electrode, voltage)
+            fields = self.fields.copy()
+            fields[fieldname] = field
+            new_voltages = self.calculate_voltages(fields)
+            yield self.do_set_voltages(new_voltages)
+            self.fields = fields
             self.voltages.update(new_voltages)
-            for electrode, voltage in self.voltages.iteritems():
-                yield self.do_set_voltage(electrode, voltage)
             self.on_new_voltages()
             self.notifyOtherListeners(c, (fieldname,field), self.on_new_value)
         returnValue(self.fields[fieldname])
     
+    @setting(5, "Voltages For Fields", fields = '*2v', returns = '*2v')
+    def voltages_for_fields(self, c, fields):
+        '''
+        Maps a grid of target fields, one row of (Ex, Ey, Ez, w_z_sq) per point, to the voltages (C1, C2, D1, D2) of each point
+        without setting them. Raises if any point is out of the range of the electrodes that are connected.
+        '''
+        fields = np.asarray(fields, dtype = np.float64)
+        if not fields.size: return np.zeros((0, 4))
+        if fields.ndim != 2 or fields.shape[1] != 4: raise Exception("Each point needs the four fields (Ex, Ey, Ez, w_z_sq)")
+        M, M_inv = self.matrices()
+        voltages = fields.dot(M.T)
+        self.check_ranges(voltages)
+        return voltages
+    
     @inlineCallbacks
     def do_get_voltage(self, electrode):
         if electrode == 'C1':
@@ -267,25 +260,78 @@ class Electrode_Diagonalization( LabradServer ):
             raise Exception("Wrong electrode")
         returnValue(voltage)
     
+    @inlineCallbacks
+    def do_set_voltages(self, voltages):
+        '''
+        sets all the electrodes in the dictionary, the ranges are checked first so that nothing is set if one is out of range.
+        the endcaps are written in a single request to the DAC and sent together with the compensation voltages.
+        '''
+        for electrode, voltage in voltages.iteritems():
+            self.check_range(electrode, voltage)
+        requests = [self.do_set_voltage(electrode, voltages[electrode]) for electrode in ['C1','C2'] if electrode in voltages]
+        endcaps = [(channel, voltages[electrode]) for electrode, channel in [('D1','comp1'),('D2','comp2')] if electrode in voltages]
+        if endcaps:
+            requests.append(self.dac.set_voltages(endcaps))
+        yield self.gather(requests)
+    
+    @inlineCallbacks
+    def gather(self, requests):
+        '''waits for the requests sent together, returns their results in order or raises the first error'''
+        try:
+            results = yield DeferredList(requests, fireOnOneErrback = True, consumeErrors = True)
+        except FirstError as error:
+            error.subFailure.raiseException()
+        returnValue([result for success, result in results])
+    
     def check_range(self, electrode, voltage):
         if electrode in ['C1','C2']:
             voltage = -voltage
-            print 'checkig range', electrode, voltage
             minim,maxim = self.voltage_range_comp
         elif electrode in ['D1','D2']:
             minim,maxim = self.voltage_range_dac
-        if not minim <= voltage and voltage <= maxim:
+        else:
+            raise Exception("Wrong electrode")
+        if minim is not None and not minim <= voltage <= maxim:
             raise Exception( "Voltage out of Range {}".format(electrode)) 
-        
-    def rotation_matrx(self):
+    
+    def check_ranges(self, voltages):
+        '''
+        checks an array of voltages with one row of (C1, C2, D1, D2) per point, raises on the first point out of range
+        '''
+        allowed = np.ones(voltages.shape, dtype = bool)
+        for columns, sign, voltage_range in [(slice(0, 2), -1, self.voltage_range_comp), (slice(2, 4), 1, self.voltage_range_dac)]:
+            minim, maxim = voltage_range
+            if minim is None: continue
+            applied = sign * voltages[:, columns]
+            allowed[:, columns] = (applied >= minim['V']) & (applied <= maxim['V'])
+        outside = np.argwhere(~allowed)
+        if len(outside):
+            point, column = outside[0]
+            electrode = ['C1','C2','D1','D2'][column]
+            raise Exception( "Voltage out of Range {0} for point {1}".format(electrode, point))
+    
+    def matrices(self, parameters = None):
+        '''
+        returns the rotation matrix M and its inverse, they are only recomputed when the matrix parameters change
+        '''
+        if parameters is None: parameters = self.parameters
+        key = tuple(parameters[param] for param in ['endcap_angle','xz_angle','m0','m2'])
+        if self.matrix_key != key:
+            M = self.rotation_matrx(parameters)
+            self.matrix_cache = M, LA.inv(M)
+            self.matrix_key = key
+        return self.matrix_cache
+    
+    def rotation_matrx(self, parameters = None):
         '''
         returns the rotation matrix M such that
         Voltages = M * fields
         '''
-        theta_d = self.parameters['endcap_angle']['rad']
-        th = self.parameters['xz_angle']['rad']
-        m0 = self.parameters['m0']
-        m2 = self.parameters['m2']
+        if parameters is None: parameters = self.parameters
+        theta_d = parameters['endcap_angle']['rad']
+        th = parameters['xz_angle']['rad']
+        m0 = parameters['m0']
+        m2 = parameters['m2']
         norm = sqrt(m0 **2 + m2 **1 + 1**2)
         R1 = np.array([
                      [1,     0,      0,      0],
@@ -307,23 +353,16 @@ class Electrode_Diagonalization( LabradServer ):
         return M
     
     def calculate_fields(self):
-        M = self.rotation_matrx()
-        M_inv = LA.inv(M)
+        M, M_inv = self.matrices()
         voltages = [self.voltages[key]['V'] for key in ['C1','C2','D1','D2']]
         new_fields = M_inv.dot(voltages)
-        field_dict = {}
-        for i,field in enumerate(['Ex','Ey','Ez','w_z_sq']):
-            field_dict[field] = new_fields[i]
-        return field_dict
-    
-    def calculate_voltages(self):
-        M  = self.rotation_matrx()
-        fields = [self.fields[key] for key in ['Ex','Ey','Ez','w_z_sq']]
-        new_voltages = M.dot(fields)
-        voltage_dict = {}
-        for i,voltage in enumerate(['C1','C2','D1','D2']):
-            voltage_dict[voltage] = WithUnit(new_voltages[i], 'V')
-        return voltage_dict
+        return dict(zip(['Ex','Ey','Ez','w_z_sq'], new_fields.tolist()))
+    
+    def calculate_voltages(self, fields = None, parameters = None):
+        if fields is None: fields = self.fields
+        M, M_inv = self.matrices(parameters)
+        new_voltages = M.dot([fields[key] for key in ['Ex','Ey','Ez','w_z_sq']])
+        return dict((voltage, WithUnit(value, 'V')) for voltage, value in zip(['C1','C2','D1','D2'], new_voltages.tolist()))
     
     def on_new_voltages(self):
         for electrode, voltage in self.voltages.iteritems():
@@ -358,7 +397,7 @@ class Electrode_Diagonalization( LabradServer ):
     @inlineCallbacks
     def stopServer(self):
         try:
-            yield self.save_params_to_registry()
+            yield self.registry.flush()
         except:
             pass
         
@@ -0,0 +1,95 @@
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+class RegistryCache(object):
+    """
+    Keeps the keys of one registry directory in memory for a server.
+    The directory is loaded with a single request, values are read from memory and changes are written behind:
+    they are collected for delay seconds and then sent together in one request. When onChange is given, the changes made
+    to the directory by other clients are followed through the registry notifications and onChange(key, value) is called
+    with each new value, the values set locally and not yet written take precedence.
+    """
+    def __init__(self, client, path, notifyID = None, onChange = None, delay = 1.0):
+        self.client = client
+        self.path = path
+        self.notifyID = notifyID
+        self.onChange = onChange
+        self.delay = delay
+        self.context = client.context()
+        self.values = {}
+        self.pending = {}
+        self.scheduled = None
+
+    @inlineCallbacks
+    def load(self):
+        '''creates the directory if needed, loads all of its keys and starts following the changes if requested'''
+        registry = self.client.registry
+        p = registry.packet(context = self.context)
+        p.cd(self.path, True)
+        p.dir(key = 'dir')
+        if self.onChange is not None:
+            p.notify_on_change(self.notifyID, True)
+        result = yield p.send()
+        if self.onChange is not None:
+            yield registry.addListener(listener = self.changed, source = None, ID = self.notifyID, context = self.context)
+        subdirs, keys = result['dir']
+        if keys:
+            p = registry.packet(context = self.context)
+            for key in keys:
+                p.get(key, key = key)
+            result = yield p.send()
+            self.values.update((key, result[key]) for key in keys)
+        self.values.update(self.pending)
+        returnValue(self.values)
+
+    def get(self, key, *default):
+        '''returns the value of the key, or the default if given when the key is not in the registry'''
+        try:
+            return self.values[key]
+        except KeyError:
+            if default: return default[0]
+            raise Exception("{} not found in registry".format(key))
+
+    def set(self, key, value):
+        '''changes the value in memory right away, it is written to the registry with the other changes after the delay'''
+        self.values[key] = value
+        self.pending[key] = value
+        if self.scheduled is None:
+            self.scheduled = reactor.callLater(self.delay, self.flush)
+
+    @inlineCallbacks
+    def flush(self):
+        '''writes all the pending changes in a single request, the changes that fail are kept for the next write'''
+        if self.scheduled is not None and self.scheduled.active():
+            self.scheduled.cancel()
+        self.scheduled = None
+        pending, self.pending = self.pending, {}
+        if not pending: return
+        p = self.client.registry.packet(context = self.context)
+        p.cd(self.path, True)
+        for key, value in pending.iteritems():
+            p.set(key, value)
+        try:
+            yield p.send()
+        except Exception as e:
+            #keep the changes that were not superseded for the next write
+            for key, value in pending.iteritems():
+                self.pending.setdefault(key, value)
+            print 'Could not write {0} to registry: {1}'.format(sorted(pending), e)
+            if self.scheduled is None:
+                self.scheduled = reactor.callLater(self.delay, self.flush)
+
+    @inlineCallbacks
+    def changed(self, c, message):
+        name, isDir, addOrChange = message
+        if isDir or name in self.pending: return
+        if addOrChange:
+            value = yield self.client.registry.get(name, context = self.context)
+            if name not in self.pending:
+                self.values[name] = value
+                try:
+                    yield self.onChange(name, value)
+                except Exception as e:
+                    print 'Could not apply the registry change of {0}: {1}'.format(name, e)
+        else:
+            self.values.pop(name, None)
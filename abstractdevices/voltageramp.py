@@ -0,0 +1,72 @@
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+import time
+import numpy
+
+class VoltageRamp(object):
+    """
+    Moves several channels together from their voltages to the targets along a linear or S-curve trajectory.
+    At every update the setpoints of all the channels are computed from the elapsed time and written with a single call,
+    so that the channels move in sync and the ramp keeps its duration even when the writes are slow.
+    The S-curve starts and ends with zero speed and acceleration, its peak speed is 1.875 times the one of the linear ramp.
+    """
+    profiles = {
+                'linear': lambda x: x,
+                'scurve': lambda x: x**3 * (10 - 15 * x + 6 * x**2),
+                }
+    peakSpeed = {'linear': 1.0, 'scurve': 1.875}
+
+    def __init__(self, write, rate, progress = None):
+        '''
+        write(channels, voltages) sets the list of channels to the array of voltages and returns a deferred.
+        rate is the default number of updates per second, progress(fraction, channels, voltages) is called after every update.
+        '''
+        self.write = write
+        self.rate = rate
+        self.progress = progress
+        self.running = False
+        self.cancelled = False
+
+    def checkProfile(self, profile):
+        if profile not in self.profiles: raise Exception ("Unknown ramp profile {}".format(profile))
+
+    def checkRate(self, rate):
+        if rate is not None and not rate > 0: raise Exception ("Ramp update rate must be positive")
+
+    @inlineCallbacks
+    def ramp(self, channels, starts, targets, duration, profile = 'linear', rate = None):
+        '''
+        ramps the channels with rate updates per second, the default rate if not given.
+        returns True when the targets are reached or False if the ramp was cancelled
+        '''
+        self.checkProfile(profile)
+        self.checkRate(rate)
+        if self.running: raise Exception ("A ramp is already in progress")
+        if rate is None: rate = self.rate
+        shape = self.profiles[profile]
+        starts = numpy.asarray(starts, dtype = numpy.float64)
+        targets = numpy.asarray(targets, dtype = numpy.float64)
+        self.running = True
+        self.cancelled = False
+        try:
+            began = time.time()
+            fraction = 0.0
+            while fraction < 1.0:
+                if self.cancelled: returnValue(False)
+                fraction = min((time.time() - began) / duration, 1.0) if duration > 0 else 1.0
+                voltages = starts + (targets - starts) * shape(fraction)
+                yield self.write(channels, voltages)
+                if self.progress is not None: self.progress(fraction, channels, voltages)
+                if fraction < 1.0: yield self.wait(1.0 / rate)
+        finally:
+            self.running = False
+        returnValue(True)
+
+    def cancel(self):
+        '''stops the ramp in progress at the last written setpoints'''
+        if self.running: self.cancelled = True
+
+    def wait(self, seconds):
+        d = Deferred()
+        reactor.callLater(seconds, d.callback, None)
+        return d
@@ -1,4 +1,11 @@
-import ok
+import os
+simulatedBoard = False #use the in-process simulation of the board in simulator_dac.py instead of the Opal Kelly module
+#the environment variable SIMULATE_OK_BOARDS overrides simulatedBoard when it is set, 1 for the simulation and 0 for the board
+simulated = os.environ.get('SIMULATE_OK_BOARDS', str(int(simulatedBoard))) not in ('', '0')
+if simulated:
+    import simulator_dac as ok
+else:
+    import ok
 
 class api_dac():
     '''class containing all commands for interfacing with the fpga'''
@@ -40,3 +47,14 @@ class api_dac():
     def getVoltage(self, channel):
         self.xem.UpdateWireOuts()
         return self.xem.GetWireOutValue(32+channel)
+    
+    def setVoltages(self, channels, values):
+        '''sets the values of all the channels with a single update of the wire ins'''
+        for channel,value in zip(channels, values):
+            self.xem.SetWireInValue(channel,value)
+        self.xem.UpdateWireIns()
+    
+    def getVoltages(self, channels):
+        '''reads back the values of all the channels with a single update of the wire outs'''
+        self.xem.UpdateWireOuts()
+        return [self.xem.GetWireOutValue(32+channel) for channel in channels]
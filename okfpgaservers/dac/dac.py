@@ -22,6 +22,9 @@ from labrad.units import WithUnit
 from twisted.internet.defer import inlineCallbacks, returnValue, DeferredLock
 from twisted.internet.threads import deferToThread
 from api_dac import api_dac
+from lattice.abstractdevices.registrycache import RegistryCache
+from lattice.abstractdevices.voltageramp import VoltageRamp
+import numpy
 
 
 class dac_channel(object):
@@ -44,11 +47,17 @@ class DAC(LabradServer):
     
     name = 'DAC'
     onNewVoltage = Signal(123556, 'signal: new voltage', '(sv)')
+    onNewVoltages = Signal(123557, 'signal: new voltages', '*(sv)')
+    onRampProgress = Signal(123558, 'signal: ramp progress', '(v*(sv))')
+    ramp_rate = 100.0 #default setpoint updates per second when ramping
     
     @inlineCallbacks
     def initServer(self):
         self.api_dac  = api_dac()
         self.inCommunication = DeferredLock()
+        self.ramp = VoltageRamp(self.write_voltages, self.ramp_rate, self.ramp_progress)
+        self.registry = RegistryCache(self.client, ['','Servers', 'DAC'])
+        yield self.registry.load()
         connected = self.api_dac.connectOKBoard()
         if not connected:
             raise Exception ("Could not connect to DAC")
@@ -66,21 +75,19 @@ class DAC(LabradServer):
                              ('endcap2', 3, -9.9561, 20.0),
                              ]:
             chan = dac_channel(name, channel_number, min_voltage, vpp)
-            chan.voltage = yield self.getRegValue(name)
+            chan.voltage = self.getRegValue(name)
             d[name] = chan
             value = self.voltage_to_val(chan.voltage, chan.min_voltage, chan.vpp)
             yield self.do_set_voltage(channel_number, value)
         returnValue( d )
     
-    @inlineCallbacks
     def getRegValue(self, name):
-        yield self.client.registry.cd(['','Servers', 'DAC'], True)
         try:
-            voltage = yield self.client.registry.get(name)
+            voltage = self.registry.get(name)
         except Exception:
             print '{} not found in registry'.format(name)
             voltage = 0
-        returnValue(voltage)
+        return voltage
             
     @setting(0, "Set Voltage",channel = 's', voltage = 'v[V]', returns = '')
     def setVoltage(self, c, channel, voltage):
@@ -93,27 +100,97 @@ class DAC(LabradServer):
         value = self.voltage_to_val(voltage, minim, total)
         yield self.do_set_voltage(channel_number, value)
         chan.voltage = voltage
+        self.registry.set(channel, voltage)
         self.notifyOtherListeners(c, (channel, voltage), self.onNewVoltage)
     
+    @setting(4, "Set Voltages", voltages = '*(sv[V])', returns = '')
+    def setVoltages(self, c, voltages):
+        """
+        Sets the voltages of several channels together, given as a list of (channel, voltage).
+        All the channels are updated at once by the board and the change is announced with a single 'signal: new voltages'.
+        """
+        if not len(voltages): return
+        names, volts = self.get_channel_voltages(voltages)
+        yield self.write_voltages(names, volts)
+        self.notifyOtherListeners(c, zip(names, volts.tolist()), self.onNewVoltages)
+    
+    @setting(5, "Ramp Voltages", voltages = '*(sv[V])', duration = 'v[s]', profile = 's', rate = 'v[Hz]', returns = 'b')
+    def rampVoltages(self, c, voltages, duration, profile = 'linear', rate = None):
+        """
+        Ramps several channels together from their voltages to the given (channel, voltage) targets over the duration.
+        The profile is either 'linear' or 'scurve' which starts and stops smoothly. The setpoints are updated at the
+        given rate, 100 Hz by default. The progress is announced with the 'signal: ramp progress'.
+        Returns True once the targets are reached or False if the ramp was cancelled.
+        """
+        names, targets = self.get_channel_voltages(voltages)
+        self.ramp.checkProfile(profile)
+        if rate is not None: rate = rate['Hz']
+        self.ramp.checkRate(rate)
+        self.voltages_to_vals(targets, *self.get_calibration(names))
+        starts = [self.d[name].voltage for name in names]
+        completed = yield self.ramp.ramp(names, starts, targets, duration['s'], profile, rate)
+        self.notifyOtherListeners(c, [(name, self.d[name].voltage) for name in names], self.onNewVoltages)
+        returnValue(completed)
+    
+    @setting(6, "Cancel Ramp", returns = '')
+    def cancelRamp(self, c):
+        """Stops the ramp in progress at the voltages reached so far"""
+        self.ramp.cancel()
+    
+    def get_channel_voltages(self, voltages):
+        '''checks the list of (channel, voltage) and returns the list of channel names and the array of voltages'''
+        names = [name for name,voltage in voltages]
+        if len(set(names)) != len(names): raise Exception ("Channels can only be set once")
+        for name in names:
+            if name not in self.d: raise Exception ("Channel {} not found".format(name))
+        return names, numpy.array([voltage['V'] for name,voltage in voltages])
+    
+    def get_calibration(self, names):
+        '''returns the arrays of the minimum voltages and the voltage ranges of the channels'''
+        chans = [self.d[name] for name in names]
+        return numpy.array([chan.min_voltage for chan in chans]), numpy.array([chan.vpp for chan in chans])
+    
     @inlineCallbacks
+    def write_voltages(self, names, volts):
+        '''sets the channels to the array of voltages with a single update of the board'''
+        values = self.voltages_to_vals(volts, *self.get_calibration(names))
+        yield self.do_set_voltages([self.d[name].channel_number for name in names], values.tolist())
+        for name,voltage in zip(names, volts.tolist()):
+            self.d[name].voltage = voltage
+            self.registry.set(name, voltage)
+    
+    def ramp_progress(self, fraction, names, volts):
+        self.onRampProgress((fraction, zip(names, volts.tolist())))
+    
     def do_set_voltage(self, channel_number, value):
+        return self.do_set_voltages([channel_number], [value])
+    
+    @inlineCallbacks
+    def do_set_voltages(self, channel_numbers, values):
         yield self.inCommunication.acquire()
         try:
-            yield deferToThread(self.api_dac.setVoltage, channel_number, value)
-            confirmation = yield deferToThread(self.api_dac.getVoltage, channel_number)
-            print 'setting value', value
-            if not value == confirmation:
+            confirmation = yield deferToThread(self._write_voltages, channel_numbers, values)
+            if not values == confirmation:
                 raise Exception("Board did not set the voltage not set properly")
-        except Exception as e:
-            raise e
         finally:
             self.inCommunication.release()
+    
+    def _write_voltages(self, channel_numbers, values):
+        '''writes the values and reads them back in the same thread'''
+        self.api_dac.setVoltages(channel_numbers, values)
+        return self.api_dac.getVoltages(channel_numbers)
         
     def voltage_to_val(self, voltage, minim, total, prec = 16):
         '''converts voltage of a channel to FPGA-understood sequential value'''
         value = int((voltage - minim) / total * (2 ** prec  - 1) )
         if not  0 <= value <= 2**16 - 1: raise Exception ("Voltage Out of Range")
         return value
+    
+    def voltages_to_vals(self, voltages, minims, totals, prec = 16):
+        '''converts the arrays of voltages of the channels to FPGA-understood sequential values'''
+        values = ((voltages - minims) / totals * (2 ** prec  - 1)).astype(numpy.int64)
+        if not ((0 <= values) & (values <= 2**16 - 1)).all(): raise Exception ("Voltage Out of Range")
+        return values
            
     @setting(1, "Get Voltage", channel = 's', returns = 'v[V]')
     def getVoltage(self, c, channel):
@@ -151,9 +228,9 @@ class DAC(LabradServer):
     def stopServer(self):
         '''save the latest voltage information into registry'''
         try:
-            yield self.client.registry.cd(['','Servers', 'DAC'], True)
             for name,channel in self.d.iteritems():
-                yield self.client.registry.set(name, channel.voltage)
+                self.registry.set(name, channel.voltage)
+            yield self.registry.flush()
         except AttributeError:
             #if dictionary doesn't exist yet (i.e bad identification error), do nothing
             pass
@@ -170,6 +247,7 @@ class DAC(LabradServer):
             value = self.voltage_to_val(voltage_value, minim, total)
             yield self.do_set_voltage(channel_number, value)
             chan.voltage = voltage_value
+            self.registry.set(channel, voltage_value)
             self.notifyOtherListeners(c, (channel, voltage_value), self.onNewVoltage)
 
 if __name__ == "__main__":
@@ -0,0 +1,67 @@
+'''
+In-process simulation of the DAC board, used in place of the Opal Kelly ok module when api_dac.simulatedBoard is set or the environment variable SIMULATE_OK_BOARDS=1.
+It provides FrontPanel and PLL22150 with the interface of the ok module. As with the firmware,
+the value of a channel set through the wire in of the channel is read back from the wire out 32 + channel.
+'''
+import time
+
+SERIAL = 'SIMULATED'
+LATENCY = 0.0002 #seconds added to every simulated USB transfer
+
+class PLL22150(object):
+    DivSrc_VCO = 1
+    def SetDiv1(self, source, divider):
+        self.div1 = (source, divider)
+
+class FrontPanel(object):
+    '''emulates the board running the DAC firmware'''
+    def __init__(self):
+        self.latency = LATENCY
+        self.wireIns = [0] * 32 #pending values, latched by UpdateWireIns
+        self.wires = [0] * 32
+        self.wireOuts = [0] * 32
+        self.opened = False
+
+    def _transfer(self):
+        '''waits for the simulated USB round trip'''
+        if self.latency: time.sleep(self.latency)
+
+    def GetDeviceCount(self):
+        return 1
+
+    def GetDeviceListSerial(self, i):
+        return SERIAL
+
+    def OpenBySerial(self, serial):
+        self.opened = (serial == SERIAL)
+        return 0 if self.opened else -1
+
+    def GetDeviceID(self):
+        return 'DAC' if self.opened else ''
+
+    def ConfigureFPGA(self, filename):
+        self._transfer()
+        return 0
+
+    def GetEepromPLL22150Configuration(self, pll):
+        return 0
+
+    def SetPLL22150Configuration(self, pll):
+        return 0
+
+    def SetWireInValue(self, addr, value, mask = 0xffffffff):
+        self.wireIns[addr] = (self.wireIns[addr] & ~mask) | (value & mask)
+        return 0
+
+    def UpdateWireIns(self):
+        self._transfer()
+        self.wires = list(self.wireIns)
+        return 0
+
+    def UpdateWireOuts(self):
+        self._transfer()
+        self.wireOuts = list(self.wires)
+        return 0
+
+    def GetWireOutValue(self, addr):
+        return self.wireOuts[addr - 0x20]
@@ -1,5 +1,12 @@
-import ok
 from hardwareConfiguration import hardwareConfiguration
+import os
+#the environment variable SIMULATE_OK_BOARDS overrides simulatedBoard when it is set, 1 for the simulation and 0 for the board
+simulatedBoard = getattr(hardwareConfiguration, 'simulatedBoard', False)
+simulated = os.environ.get('SIMULATE_OK_BOARDS', str(int(simulatedBoard))) not in ('', '0')
+if simulated:
+    import simulator as ok
+else:
+    import ok
 
 class api(object):
     '''class containing all commands for interfacing with the fpga'''
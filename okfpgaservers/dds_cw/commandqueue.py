@@ -0,0 +1,70 @@
+import threading
+from collections import deque
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+class CommandQueue(object):
+    """
+    Runs the commands for the FPGA in order on a single dedicated worker thread.
+    A command is a batch of calls that is executed as one job, without returning to the reactor in between.
+    Queries are status reads, like whether the sequence is done, that run before any commands still waiting in the queue.
+    They only select and read a status wire, reading the FIFOs has to be a command so that it stays in order with their resets.
+    Every submission returns a deferred that fires with the result of the last call of the batch.
+    """
+    def __init__(self, name = 'FPGA'):
+        self.commands = deque()
+        self.queries = deque()
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.thread = threading.Thread(target = self._work, name = '{} command queue'.format(name))
+        self.thread.daemon = True
+        self.thread.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def run(self, f, *args):
+        '''submits a single call'''
+        return self.batch((f,) + args)
+
+    def batch(self, *calls):
+        '''submits the calls, each in the form (function, arg1, arg2, ...), to run together in one job'''
+        return self._submit(self.commands, calls)
+
+    def query(self, f, *args):
+        '''submits a status read that does not have to wait for the queued commands, it must not read or reset the FIFOs'''
+        return self._submit(self.queries, [(f,) + args])
+
+    def _submit(self, queue, calls):
+        d = Deferred()
+        with self.condition:
+            if self.stopping: raise Exception("FPGA command queue is stopped")
+            queue.append((d, calls))
+            self.condition.notify()
+        return d
+
+    def stop(self):
+        '''lets the worker finish the submitted jobs and exit'''
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+
+    def _next(self):
+        with self.condition:
+            while not (self.queries or self.commands or self.stopping):
+                self.condition.wait()
+            if self.queries: return self.queries.popleft()
+            if self.commands: return self.commands.popleft()
+            return None
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if job is None: return
+            d, calls = job
+            try:
+                for call in calls:
+                    result = call[0](*call[1:])
+            except Exception:
+                reactor.callFromThread(d.errback, Failure())
+            else:
+                reactor.callFromThread(d.callback, result)
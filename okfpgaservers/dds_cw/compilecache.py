@@ -0,0 +1,50 @@
+from collections import OrderedDict
+
+class CompileCache(object):
+    """
+    Least recently used cache of compiled sequences in the form key:(ddsSettings, ttlProgram)
+    The total size of the cached programs is kept under the memory budget given in bytes.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def programSize(compiled):
+        dds, ttl = compiled
+        size = len(ttl)
+        if dds is not None:
+            size += sum(len(buf) for buf in dds.itervalues())
+        return size
+
+    def get(self, key):
+        '''returns the compiled program for the key or None if it is not cached'''
+        try:
+            compiled = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries[key] = compiled #move to the most recently used position
+        self.hits += 1
+        return compiled
+
+    def add(self, key, compiled):
+        size = self.programSize(compiled)
+        if size > self.budget: return
+        if key in self.entries:
+            self.size -= self.programSize(self.entries.pop(key))
+        while self.size + size > self.budget:
+            oldKey, oldCompiled = self.entries.popitem(last = False)
+            self.size -= self.programSize(oldCompiled)
+        self.entries[key] = compiled
+        self.size += size
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
@@ -1,9 +1,12 @@
 from labrad.server import LabradServer, setting, Signal
-from twisted.internet.defer import returnValue, inlineCallbacks
-from twisted.internet.threads import deferToThread
+from twisted.internet.defer import returnValue, inlineCallbacks, DeferredList
 import array
+import time
+import numpy
 from labrad.units import WithUnit
 from errors import dds_access_locked
+from ddsencoder import DDSEncoder
+from hardwareConfiguration import hardwareConfiguration
 
 class DDS(LabradServer):
     
@@ -14,13 +17,17 @@ class DDS(LabradServer):
     @inlineCallbacks
     def initializeDDS(self):
         self.ddsLock = False
+        self.ddsBuffers = {} #last buffer programmed into each local channel
+        self.remoteLatency = {} #seconds taken to program each remote during the last upload
         self.api.initializeDDS()
         for name,channel in self.ddsDict.iteritems():
             channel.name = name
+        self.ddsEncoders = dict((name, DDSEncoder(channel)) for name,channel in self.ddsDict.iteritems())
+        for name,channel in self.ddsDict.iteritems():
             freq,ampl = (channel.frequency, channel.amplitude)
             self._checkRange('amplitude', channel, ampl)
             self._checkRange('frequency', channel, freq)
-            yield self.inCommunication.run(self._setParameters, channel, freq, ampl)
+            yield self._setParameters(channel, freq, ampl)
     
     @setting(41, "Get DDS Channels", returns = '*s')
     def getDDSChannels(self, c):
@@ -74,43 +81,98 @@ class DDS(LabradServer):
         '''
         sequence = c.get('sequence')
         if not sequence: raise Exception ("Please create new sequence first")
+        pulses = []
         for value in values:
             try:
                 name,start,dur,freq,ampl = value
                 phase  = 0.0
             except ValueError:
                 name,start,dur,freq,ampl,phase = value
-            try:
-                channel = self.ddsDict[name]
-            except KeyError:
-                raise Exception("Unknown DDS channel {}".format(name))
-            start = start['s']
-            dur = dur['s']
-            freq = freq['MHz']
-            ampl = ampl['dBm']
-            phase = phase['deg']
+            pulses.append((name, start['s'], dur['s'], freq['MHz'], ampl['dBm'], phase['deg']))
+        if not pulses: return
+        names = numpy.array([pulse[0] for pulse in pulses], dtype = object)
+        starts, durs, freqs, ampls, phases = [numpy.array(column, dtype = numpy.float64) for column in zip(*pulses)[1:]]
+        #find the first invalid pulse, and raise the same error as checking the pulses one by one
+        valid = numpy.zeros(len(pulses), dtype = bool)
+        for name in set(names):
+            if name not in self.ddsDict: continue
+            channel = self.ddsDict[name]
+            selected = names == name
+            freq, ampl = freqs[selected], ampls[selected]
+            off = (freq == 0) | (ampl == 0)
+            in_range = lambda r, val: (r[0] <= val) & (val <= r[1])
+            valid[selected] = off | (in_range(channel.allowedfreqrange, freq) & in_range(channel.allowedamplrange, ampl))
+        low, high = self.sequenceTimeRange
+        valid &= (low < starts) & (starts <= high) & (low < starts + durs) & (starts + durs <= high)
+        if not valid.all():
+            self._checkDDSPulse(*pulses[numpy.nonzero(~valid)[0][0]][:5])
+        nums = numpy.empty(len(pulses), dtype = object)
+        nums_off = numpy.empty(len(pulses), dtype = object)
+        for name in set(names):
+            channel = self.ddsDict[name]
+            encoder = self.ddsEncoders[name]
+            selected = names == name
+            freq, ampl, phase = freqs[selected], ampls[selected], phases[selected]
             freq_off, ampl_off = channel.off_parameters
-            if freq == 0 or ampl == 0: #off state
-                freq, ampl = freq_off,ampl_off
-            else:
-                self._checkRange('frequency', channel, freq)
-                self._checkRange('amplitude', channel, ampl)
-            num = self.settings_to_num(channel, freq, ampl, phase)
+            off = (freq == 0) | (ampl == 0) #off state
+            freq, ampl = numpy.where(off, freq_off, freq), numpy.where(off, ampl_off, ampl)
+            nums[selected] = encoder.toNums(freq, ampl, phase)
             if not channel.phase_coherent_model:
-                num_off = self.settings_to_num(channel, freq_off, ampl_off)
+                nums_off[selected] = encoder.toNum(freq_off, ampl_off)
             else:
                 #note that keeping the frequency the same when switching off to preserve phase coherence
-                num_off = self.settings_to_num(channel, freq, ampl_off, phase) 
-            #note < sign, because start can not be 0. 
-            #this would overwrite the 0 position of the ram, and cause the dds to change before pulse sequence is launched
-            if not self.sequenceTimeRange[0] < start <= self.sequenceTimeRange[1]: 
-                raise Exception ("DDS start time out of acceptable input range for channel {0} at time {1}".format(name, start))
-            if not self.sequenceTimeRange[0] < start + dur <= self.sequenceTimeRange[1]: 
-                raise Exception ("DDS start time out of acceptable input range for channel {0} at time {1}".format(name, start + dur))
-            if not dur == 0:#0 length pulses are ignored
-                sequence.addDDS(name, start, num, 'start')
-                sequence.addDDS(name, start + dur, num_off, 'stop')
-        
+                nums_off[selected] = encoder.toNums(freq, numpy.ones(len(freq)) * ampl_off, phase)
+        added = durs != 0 #0 length pulses are ignored
+        steps = sequence.timeBase.secToSteps(starts[added])
+        stops = sequence.timeBase.secToSteps((starts + durs)[added])
+        sequence.addDDSPulses(names[added].tolist(), steps, stops, nums[added].tolist(), nums_off[added].tolist())
+
+    def _checkDDSPulse(self, name, start, dur, freq, ampl):
+        '''checks a single dds pulse, raising the error for the first problem found'''
+        try:
+            channel = self.ddsDict[name]
+        except KeyError:
+            raise Exception("Unknown DDS channel {}".format(name))
+        if not (freq == 0 or ampl == 0):
+            self._checkRange('frequency', channel, freq)
+            self._checkRange('amplitude', channel, ampl)
+        #note < sign, because start can not be 0. 
+        #this would overwrite the 0 position of the ram, and cause the dds to change before pulse sequence is launched
+        if not self.sequenceTimeRange[0] < start <= self.sequenceTimeRange[1]: 
+            raise Exception ("DDS start time out of acceptable input range for channel {0} at time {1}".format(name, start))
+        if not self.sequenceTimeRange[0] < start + dur <= self.sequenceTimeRange[1]: 
+            raise Exception ("DDS start time out of acceptable input range for channel {0} at time {1}".format(name, start + dur))
+
+    @setting(50, 'Add DDS Pulses Binary', names = '*s', channels = '*w', starts = '*w', durations = '*w', frequencies = '*w', amplitudes = '*w', phases = '*w', returns = '')
+    def addDDSPulsesBinary(self, c, names, channels, starts, durations, frequencies, amplitudes, phases):
+        '''
+        Add many DDS pulses at once given as arrays. The channels are indices into the list of names.
+        Times are in the units of the time resolution and frequencies, amplitudes and phases are the words programmed into the dds.
+        Phases are ignored for channels that are not phase coherent.
+        '''
+        sequence = c.get('sequence')
+        if not sequence: raise Exception ("Please create new sequence first")
+        arrays = [numpy.asarray(arr, dtype = numpy.int64) for arr in (channels, starts, durations, frequencies, amplitudes, phases)]
+        if len(set(map(len, arrays))) > 1: raise Exception ("All the pulse arrays must have the same length")
+        channels, starts, durations, frequencies, amplitudes, phases = arrays
+        if not (channels < len(names)).all(): raise Exception ("Channel index out of range of the provided names")
+        #note < sign, because start can not be 0, same as in 'add dds pulses'
+        minStep, maxStep = [sequence.secToStep(t) for t in self.sequenceTimeRange]
+        if not ((minStep < starts) & (starts + durations <= maxStep)).all(): raise Exception ("DDS times out of acceptable input range")
+        if not (phases < 2**16).all(): raise Exception ("Phase word out of range")
+        for index, name in enumerate(names):
+            try:
+                channel = self.ddsDict[name]
+            except KeyError:
+                raise Exception("Unknown DDS channel {}".format(name))
+            selected = (channels == index) & (durations > 0) #0 length pulses are ignored
+            start, dur = starts[selected], durations[selected]
+            freq, ampl, phase = frequencies[selected], amplitudes[selected], phases[selected]
+            self._checkWordRange('frequency', channel, freq)
+            self._checkWordRange('amplitude', channel, ampl)
+            num, num_off = self._wordsToNums(channel, freq, ampl, phase)
+            sequence.addDDSPulses([name] * len(start), start, start + dur, num, num_off)
+
     @setting(46, 'Get DDS Amplitude Range', name = 's', returns = '(vv)')
     def getDDSAmplRange(self, c, name = None):
         channel = self._getChannel(c, name)
@@ -138,14 +200,57 @@ class DDS(LabradServer):
     @setting(49, 'Clear DDS Lock')
     def clear_dds_lock(self, c):
         self.ddsLock = False
-    
+
+    @setting(51, 'Get Remote DDS Latency', returns = '*(sv[s])')
+    def getRemoteDDSLatency(self, c):
+        """Returns the time it took to program each remote during the last upload, remotes that were not programmed are left out"""
+        return [(name, WithUnit(latency, 's')) for name,latency in self.remoteLatency.iteritems()]
+
     def _checkRange(self, t, channel, val):
         if t == 'amplitude':
             r = channel.allowedamplrange
         elif t == 'frequency':
             r = channel.allowedfreqrange
         if not r[0]<= val <= r[1]: raise Exception ("channel {0} : {1} of {2} is outside the allowed range".format(channel.name, t, val))
-    
+
+    def _checkWordRange(self, t, channel, words):
+        '''vectorized version of _checkRange for an array of frequency or amplitude words'''
+        if t == 'amplitude':
+            r = channel.allowedamplrange
+        elif t == 'frequency':
+            r = channel.allowedfreqrange
+        low, high = [self._settingWord(t, channel, val) for val in r]
+        outside = words[(words < low) | (words > high)]
+        if len(outside): raise Exception ("channel {0} : {1} word of {2} is outside the allowed range".format(channel.name, t, outside[0]))
+
+    def _settingWord(self, t, channel, val):
+        '''returns the word representing the frequency or amplitude value in the dds setting'''
+        freq_min, ampl_min = channel.boardfreqrange[0], channel.boardamplrange[0]
+        if not channel.phase_coherent_model:
+            if t == 'frequency':
+                return self._valToInt(channel, val, ampl_min) // 2**16
+            return self._valToInt(channel, freq_min, val) % 2**16
+        if t == 'frequency':
+            return self._valToInt_coherent(channel, val, ampl_min) % 2**32
+        return (self._valToInt_coherent(channel, freq_min, val) // 2**32) % 2**16
+
+    def _wordsToNums(self, channel, freqs, ampls, phases):
+        '''
+        combines the arrays of frequency, amplitude and phase words into the integer representations of the dds settings
+        returns the lists of settings for the pulses and for switching the pulses off
+        '''
+        freqs, ampls, phases = [arr.astype(numpy.uint64) for arr in (freqs, ampls, phases)]
+        freq_off, ampl_off = channel.off_parameters
+        if not channel.phase_coherent_model:
+            nums = freqs * numpy.uint64(2**16) + ampls
+            nums_off = [self.settings_to_num(channel, freq_off, ampl_off)] * len(nums)
+            return nums.tolist(), nums_off
+        #note that keeping the frequency the same when switching off to preserve phase coherence
+        ampl_off = numpy.uint64(self._settingWord('amplitude', channel, ampl_off))
+        nums = freqs + numpy.uint64(2**32) * ampls + numpy.uint64(2**48) * phases
+        nums_off = freqs + numpy.uint64(2**32) * ampl_off + numpy.uint64(2**48) * phases
+        return nums.tolist(), nums_off.tolist()
+
     def _getChannel(self,c, name):
         try:
             channel = self.ddsDict[name]
@@ -156,28 +261,62 @@ class DDS(LabradServer):
     @inlineCallbacks
     def _setAmplitude(self, channel, ampl):
         freq = channel.frequency
-        yield self.inCommunication.run(self._setParameters, channel, freq, ampl)
+        yield self._setParameters(channel, freq, ampl)
         
     @inlineCallbacks
     def _setFrequency(self, channel, freq):
         ampl = channel.amplitude
-        yield self.inCommunication.run(self._setParameters, channel, freq, ampl)
+        yield self._setParameters(channel, freq, ampl)
     
     @inlineCallbacks
     def _setOutput(self, channel, state):
         if state and not channel.state: #if turning on, and is currently off
-            yield self.inCommunication.run(self._setParameters, channel, channel.frequency, channel.amplitude)
+            yield self._setParameters(channel, channel.frequency, channel.amplitude)
         elif (channel.state and not state): #if turning off and is currenly on
             freq,ampl = channel.off_parameters
-            yield self.inCommunication.run(self._setParameters, channel, freq, ampl)
+            yield self._setParameters(channel, freq, ampl)
     
     @inlineCallbacks
     def _programDDSSequence(self, dds):
-        '''takes the parsed dds sequence and programs the board with it'''
+        '''
+        takes the parsed dds sequence and programs the board with it
+        with incrementalDDSUpload, local channels already holding the same buffer are not reprogrammed
+        returns the number of bytes uploaded and skipped
+        '''
         self.ddsLock = True
+        start = time.time()
+        skipped = 0
+        local, remote = [], {}
         for name,channel in self.ddsDict.iteritems():
             buf = dds[name]
-            yield self.program_dds_chanel(channel, buf)
+            if channel.remote:
+                remote.setdefault(channel.remote, []).append((channel.channelnumber, buf))
+            elif getattr(hardwareConfiguration, 'incrementalDDSUpload', False) and self.ddsBuffers.get(name) == buf:
+                skipped += len(buf)
+            else:
+                local.append((channel, buf))
+        #each remote is programmed with a single call, concurrently with the other remotes and with the local channels
+        self.remoteLatency = {}
+        uploads = [self._setDDSRemote(name, channels) for name,channels in remote.iteritems()]
+        if local:
+            uploads.append(self._programDDSLocal(local))
+        else:
+            #programming any local channel resets the ram position of all the chips, otherwise have to do it here
+            uploads.append(self.fpga.run(self.api.resetAllDDS))
+        #wait for every upload to finish before reporting a failure, the caller releases the upload lock on return
+        results = yield DeferredList(uploads, consumeErrors = True)
+        for success,result in results:
+            if not success: result.raiseException()
+        uploaded = sum(len(buf) for channels in [local] + remote.values() for channel,buf in channels)
+        self.recordSpan('upload dds', start, uploaded)
+        returnValue((uploaded, skipped))
+    
+    @inlineCallbacks
+    def _programDDSLocal(self, channels):
+        '''programs the list of (channel, buf) of the local channels in a single job for the board'''
+        yield self.fpga.batch(*[(self._setDDSLocal, channel.channelnumber, buf) for channel,buf in channels])
+        for channel,buf in channels:
+            self.ddsBuffers[channel.name] = buf
     
     @inlineCallbacks
     def _setParameters(self, channel, freq, ampl):
@@ -194,19 +333,16 @@ class DDS(LabradServer):
         return buf
     
     def settings_to_num(self, channel, freq, ampl, phase = 0.0):
-        if not channel.phase_coherent_model:
-            num = self._valToInt(channel, freq, ampl)
-        else:
-            num = self._valToInt_coherent(channel, freq, ampl, phase)
-        return num
+        return self.ddsEncoders[channel.name].toNum(freq, ampl, phase)
     
     @inlineCallbacks
     def program_dds_chanel(self, channel, buf):
         addr = channel.channelnumber
         if not channel.remote:
-            yield deferToThread(self._setDDSLocal, addr, buf)
+            yield self.fpga.run(self._setDDSLocal, addr, buf)
+            self.ddsBuffers[channel.name] = buf
         else:
-            yield self._setDDSRemote(channel, addr, buf)
+            yield self._setDDSRemote(channel.remote, [(addr, buf)])
     
     def _setDDSLocal(self, addr, buf):
         self.api.resetAllDDS()
@@ -214,15 +350,13 @@ class DDS(LabradServer):
         self.api.programDDS(buf)
     
     @inlineCallbacks
-    def _setDDSRemote(self, channel, addr, buf):
-        cxn = self.remoteConnections[channel.remote]
-        remote_info = self.remoteChannels[channel.remote]
-        server, reset, program = remote_info.server, remote_info.reset, remote_info.program
-        try:
-            yield cxn.servers[server][reset]()
-            yield cxn.servers[server][program]([(channel.channelnumber, buf)])
-        except (KeyError,AttributeError):
-            print 'Not programing remote channel {}'.format(channel.remote)
+    def _setDDSRemote(self, remote, channels):
+        '''programs the list of (channel number, buf) into the named remote'''
+        start = time.time()
+        latency = yield self.remoteConnections[remote].programChannels(channels)
+        if latency is not None:
+            self.remoteLatency[remote] = latency
+            self.recordSpan('upload remote {}'.format(remote), start, sum(len(buf) for channel,buf in channels))
     
     def _getCurrentDDS(self):
         '''
@@ -0,0 +1,39 @@
+import numpy
+
+class DDSEncoder(object):
+    """
+    Converts the frequency, amplitude and phase of one DDS channel into the integer representation of the dds setting.
+    The scale factors are computed once from the channel configuration. Whole arrays are converted with exactly
+    the same floating point operations as the single conversions in DDS._valToInt and DDS._valToInt_coherent,
+    so the results are identical, including the rounding by adding 0.5 in the phase coherent model.
+    """
+    def __init__(self, channel):
+        if not channel.phase_coherent_model:
+            #value range, multiplier, number of steps in the range, rounding offset
+            fields = [(channel.boardfreqrange, 256**2, 16**4 - 1, 0), (channel.boardamplrange, 1, 16**4 - 1, 0)]
+            widths = [2**16, 2**16]
+        else:
+            fields = [(channel.boardfreqrange, 1, 2**32, 0.5), (channel.boardamplrange, 2**32, 2**16, 0.5), (channel.boardphaserange, 2**48, 2**16, 0.5)]
+            widths = [2**32, 2**16, 2**16]
+        #(minimum, resolution, multiplier, rounding offset, number of words that fit in the field) for each of the values
+        self.fields = [(r[0], (r[1] - r[0]) / float(steps), m, offset, width) for (r, m, steps, offset), width in zip(fields, widths)]
+
+    def toNum(self, freq, ampl, phase = 0):
+        '''returns the integer representation of the dds setting, freq is in MHz, ampl in dBm and phase in degrees'''
+        ans = 0
+        for val, (minim, resolution, m, offset, width) in zip((freq, ampl, phase), self.fields):
+            ans += m * int((val - minim) / resolution + offset)
+        return ans
+
+    def toNums(self, freqs, ampls, phases = None):
+        '''returns the list of the integer representations of the dds settings for the arrays of values'''
+        freqs = numpy.asarray(freqs, dtype = numpy.float64)
+        if phases is None: phases = numpy.zeros(len(freqs))
+        ans = numpy.zeros(len(freqs), dtype = numpy.uint64)
+        for val, (minim, resolution, m, offset, width) in zip((freqs, ampls, phases), self.fields):
+            scaled = (numpy.asarray(val, dtype = numpy.float64) - minim) / resolution + offset
+            if not ((0 <= scaled) & (scaled < width)).all():
+                #words outside of their field do not fit the packed representation, use python integers instead
+                return [self.toNum(*values) for values in zip(freqs.tolist(), numpy.asarray(ampls).tolist(), numpy.asarray(phases).tolist())]
+            ans += numpy.uint64(m) * scaled.astype(numpy.uint64)
+        return ans.tolist()
@@ -1,6 +1,5 @@
 from labrad.server import LabradServer, setting, Signal
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.internet.threads import deferToThread
 from hardwareConfiguration import hardwareConfiguration
 from labrad.units import WithUnit
 
@@ -24,9 +23,9 @@ class LineTrigger(LabradServer):
     def line_trigger_state(self, c, enable = None):
         if enable is not None:
             if enable:
-                yield self.inCommunication.run(self._enableLineTrigger, self.linetrigger_duration)
+                yield self._enableLineTrigger(self.linetrigger_duration)
             else:
-                yield self.inCommunication.run(self._disableLineTrigger)
+                yield self._disableLineTrigger()
             self.linetrigger_enabled = enable
             self.notifyOtherListeners(c, (self.linetrigger_enabled, self.linetrigger_duration), self.on_line_trigger_param)
         returnValue (self.linetrigger_enabled)
@@ -36,7 +35,7 @@ class LineTrigger(LabradServer):
         """enable or disable line triggering. if enabling, can specify the offset_duration"""
         if duration is not None:
             if self.linetrigger_enabled:
-                yield self.inCommunication.run(self._enableLineTrigger, duration)
+                yield self._enableLineTrigger(duration)
             self.linetrigger_duration = duration
             self.notifyOtherListeners(c, (self.linetrigger_enabled, self.linetrigger_duration), self.on_line_trigger_param)
         returnValue (self.linetrigger_duration)
@@ -44,8 +43,8 @@ class LineTrigger(LabradServer):
     @inlineCallbacks   
     def _enableLineTrigger(self, delay):
         delay = int(delay['us'])
-        yield deferToThread(self.api.enableLineTrigger, delay)
+        yield self.fpga.run(self.api.enableLineTrigger, delay)
     
     @inlineCallbacks
     def _disableLineTrigger(self):
-        yield deferToThread(self.api.disableLineTrigger)
\ No newline at end of file
+        yield self.fpga.run(self.api.disableLineTrigger)
\ No newline at end of file
@@ -0,0 +1,102 @@
+from labrad.server import LabradServer, setting, Signal
+from twisted.internet.defer import inlineCallbacks
+from twisted.python import log
+from hardwareConfiguration import hardwareConfiguration
+from timetagstream import TimetagRing
+import time
+import numpy
+
+#a single PMT count: the count rate in KC/SEC, whether 866 is off and the approximate time of acquisition
+pmtRecord = numpy.dtype([('rate', '<f8'), ('off', '?'), ('time', '<f8')])
+
+class PMTHistory(TimetagRing):
+    """Fixed size ring buffer of the PMT counts, positions count all the counts ever written"""
+    def __init__(self, size):
+        self.data = numpy.zeros(size, dtype = pmtRecord)
+        self.written = 0
+
+    def between(self, start, stop):
+        '''returns the counts still available that were acquired between the start and stop times'''
+        lost, records = self.read(0)
+        return records[(records['time'] >= start) & (records['time'] <= stop)]
+
+    @staticmethod
+    def countList(records):
+        '''converts the records into the list of (count rate in KC/SEC, status, time) returned by the settings'''
+        status = numpy.where(records['off'], 'OFF', 'ON')
+        return zip(records['rate'].tolist(), status.tolist(), records['time'].tolist())
+
+class PMTStream(LabradServer):
+
+    """Collects the PMT counts in the background into a history on the server for the Pulser Server"""
+
+    on_new_pmt_counts = Signal(611055, 'signal: new pmt counts', '*(vsv)')
+
+    def initialize(self):
+        self.pmt_streaming = False
+        self.pmt_draining = False
+        self.pmt_polling = getattr(hardwareConfiguration, 'pmtPolling', 0.050)
+        self.pmt_history = PMTHistory(getattr(hardwareConfiguration, 'pmtHistorySize', 2**16))
+
+    @setting(100, 'Start PMT Stream', returns = '')
+    def startPMTStream(self, c):
+        """
+        Starts draining the PMT counts in the background into a history on the server, one read of the board serves all the clients.
+        While streaming, Get PMT Counts returns the counts recorded since the previous call in the same context,
+        and the new counts of every read are sent with the new pmt counts signal.
+        """
+        if self.pmt_streaming: return
+        self.pmt_history = PMTHistory(len(self.pmt_history.data))
+        self.pmt_streaming = True
+        if not self.pmt_draining:
+            self.pmt_draining = True
+            self._drainPMTCounts()
+
+    @setting(101, 'Stop PMT Stream', returns = '')
+    def stopPMTStream(self, c):
+        """Stops collecting the PMT counts in the background, the recorded history can still be queried"""
+        self.pmt_streaming = False
+
+    @setting(102, 'Get PMT History', start = 'v', stop = 'v', returns = '*(vsv)')
+    def getPMTHistory(self, c, start = 0, stop = None):
+        """
+        Returns the recorded PMT counts acquired between the start and stop times, given in seconds since the epoch
+        like the times of the counts. By default returns all the recorded history.
+        """
+        if stop is None: stop = numpy.inf
+        return PMTHistory.countList(self.pmt_history.between(start, stop))
+
+    def streamedPMTCounts(self, c):
+        '''returns the counts recorded since the previous request in the context, or since the start of the stream'''
+        history, position = c.get('pmt_stream', (None, 0))
+        if history is not self.pmt_history: position = 0
+        lost, records = self.pmt_history.read(position)
+        c['pmt_stream'] = (self.pmt_history, self.pmt_history.written)
+        return PMTHistory.countList(records)
+
+    def doReadNormalCounts(self):
+        inFIFO = self.api.getNormalTotal()
+        return self.api.getNormalCounts(inFIFO), time.time()
+
+    @inlineCallbacks
+    def _drainPMTCounts(self):
+        '''
+        reads the normal FIFO once per collection time, or at the polling interval when counts are collected faster.
+        '''
+        try:
+            while self.pmt_streaming:
+                buf, timeLast = yield self.fpga.run(self.doReadNormalCounts)
+                rates, off, times = self.countArrays(buf, timeLast)
+                records = numpy.zeros(len(rates), dtype = pmtRecord)
+                records['rate'], records['off'], records['time'] = rates, off, times
+                records = self.clear_pmt_counts(records)
+                if len(records):
+                    self.pmt_history.write(records)
+                    self.on_new_pmt_counts(PMTHistory.countList(records))
+                yield self.wait(max(self.collectionTime[self.collectionMode], self.pmt_polling))
+        except Exception:
+            #stop the stream so that it can be started again
+            self.pmt_streaming = False
+            log.err(None, 'PMT stream stopped')
+        finally:
+            self.pmt_draining = False
@@ -1,4 +1,5 @@
 from matplotlib import pyplot
+from itertools import groupby
 import numpy as np
 
 class SequencePlotter():
@@ -22,27 +23,19 @@ class SequencePlotter():
     def extractInfo(self):
         times = np.array(self.seq.transpose()[0], dtype = np.float)
         l =  self.seq.transpose()[1]
-        flatten = lambda x: [int(i) for i in x]
-        switches = np.array( map(flatten, l) )
+        #each state is a string of '0' and '1' characters, one per channel
+        switches = np.frombuffer(''.join(l), dtype = np.uint8).reshape(len(l), -1) - ord('0')
         switches = switches.transpose()
         return times,switches
     
     def getCoords(self, times, switches):
         '''takes the switching times and converts it to a list of coordiantes for plotting'''
-        x = [times[0]]
-        y = [switches[0]]   
-        prev = switches[0]
-        for i,switch in enumerate(switches[:-1]):
-            if switch > prev:
-                x.extend([times[i]]*2)
-                y.extend([0,1])
-            elif switch < prev:
-                x.extend([times[i]]*2)
-                y.extend([1,0])
-            prev = switch
-        x.append(times[-2])
-        y.append(switches[-2])
-        return np.array(x),np.array(y)
+        switches = np.asarray(switches, dtype = np.int64)
+        changes = np.nonzero(np.diff(switches[:-1]))[0] + 1
+        rising = (switches[changes] > switches[changes - 1]).astype(np.int64)
+        x = np.concatenate(([times[0]], np.repeat(times[changes], 2), [times[-2]]))
+        y = np.concatenate(([switches[0]], np.column_stack((1 - rising, rising)).ravel(), [switches[-2]]))
+        return x,y
                  
     def makePlot(self):
         advance,reset = self.drawTTL()
@@ -74,26 +67,10 @@ class SequencePlotter():
         advance =  list(self.getRisingEdges(*advance))
         stop = self.getRisingEdges(*reset)
         advance.extend(stop)
-        try:
-            lastChannel = self.dds[0][0]
-        except IndexError:
-            return
-        freqs = []
-        ampls = []
-        while True:
-            try:
-                channel, freq, ampl = self.dds.pop(0)
-            except IndexError:
-                self.addDDSPlot(lastChannel, freqs, ampls, advance)
-                break
-            if channel == lastChannel:
-                freqs.append(freq)
-                ampls.append(ampl)
-            else:
-                self.addDDSPlot(lastChannel, freqs, ampls, advance)
-                lastChannel = channel
-                freqs = [freq]
-                ampls = [ampl]
+        if not len(self.dds): return
+        for channel, entries in groupby(self.dds, key = lambda entry: entry[0]):
+            channels, freqs, ampls = zip(*entries)
+            self.addDDSPlot(channel, list(freqs), list(ampls), advance)
         self.drawVerticals(advance)
     
     def getRisingEdges(self, x, y):
@@ -117,14 +94,81 @@ class SequencePlotter():
         self.offset += 4
     
     def getDDSCoordinates(self, advance, ampls):
-        x = [0]
-        y = []
-        for pt_x,pt_y in zip(advance,ampls):
-            x.extend([pt_x,pt_x])
-            y.extend([pt_y,pt_y])
-        x = x[:-1]
+        number = min(len(advance), len(ampls))
+        x = np.concatenate(([0], np.repeat(advance[:number], 2)))[:-1]
+        y = np.repeat(ampls[:number], 2)
         return x,y
     
     def drawVerticals(self, advances):
-        for x in advances:
-            pyplot.axvline(x, alpha = 0.3, color = '0.35', linestyle = '--')
\ No newline at end of file
+        axes = pyplot.gca()
+        axes.vlines(advances, 0, 1, transform = axes.get_xaxis_transform(), alpha = 0.3, color = '0.35', linestyle = '--')
+
+class TimelinePlotter():
+    """
+    Plots a Timeline of a pulse sequence of any length.
+    Details shorter than the width of a point of the plot are merged: close ttl pulses are drawn as a single one
+    and the dds settings are drawn as their minimum and maximum within each point.
+    """
+    def __init__(self, timeline, points = 2000):
+        self.timeline = timeline
+        self.points = points
+        self.offset = 0 #control the y coordinate where the lines are drawn
+    
+    def makePlot(self, start = None, stop = None):
+        '''plots the sequence between the start and the stop times in seconds, by default all of it'''
+        timeline = self.timeline
+        if start is None: start = 0.0
+        if stop is None: stop = max(np.concatenate(([start], timeline.ttlStops, timeline.ddsStops)))
+        resolution = (stop - start) / float(self.points)
+        pyplot.figure()
+        self.offset = 0
+        for name in self.unique(timeline.ttlChannels):
+            starts, stops = timeline.ttlChannel(name)
+            shown = (stops >= start) & (starts <= stop)
+            x, y = self.pulseCoords(*self.mergePulses(starts[shown], stops[shown], resolution))
+            pyplot.plot(x, 3 * y + self.offset)
+            pyplot.annotate('TTL ' + name, xy = (start,  self.offset + 1.5), horizontalalignment = 'right')
+            self.offset += 4
+        for name in self.unique(timeline.ddsChannels):
+            starts, stops, freqs, ampls = timeline.ddsChannel(name)
+            shown = (stops >= start) & (starts <= stop)
+            #normalizes the amplitude -63 to -3 and the frequency 0 to 250 to heights between 0 and 3
+            for label, values in [('Amplitude', (ampls + 63.0) / 20.0), ('Frequency', freqs / 250.0)]:
+                x, low, high = self.envelope(starts[shown], values[shown], start, stop)
+                lines = pyplot.plot(x, high + self.offset, drawstyle = 'steps-post')
+                pyplot.plot(x, low + self.offset, drawstyle = 'steps-post', color = lines[0].get_color())
+                pyplot.annotate('DDS: {0} {1} '.format(name, label), xy = (start,  self.offset + 1.5), horizontalalignment = 'right')
+                self.offset += 4
+        pyplot.xlim(start, stop)
+        pyplot.xlabel('Time (sec)')
+        pyplot.show()
+    
+    @staticmethod
+    def unique(names):
+        '''returns the names in order of their first appearance'''
+        names, first = np.unique(names, return_index = True)
+        return names[np.argsort(first)]
+    
+    @staticmethod
+    def mergePulses(starts, stops, resolution):
+        '''merges the pulses separated by less than the resolution'''
+        if not len(starts): return starts, stops
+        separated = starts[1:] - stops[:-1] > resolution
+        return starts[np.concatenate(([True], separated))], stops[np.concatenate((separated, [True]))]
+    
+    @staticmethod
+    def pulseCoords(starts, stops):
+        x = np.column_stack((starts, starts, stops, stops)).ravel()
+        y = np.tile([0, 1, 1, 0], len(starts))
+        return x, y
+    
+    def envelope(self, starts, values, start, stop):
+        '''returns the times and the lowest and highest of the values set within each point of the plot'''
+        if len(starts) <= self.points:
+            return np.concatenate((starts, starts[-1:])), np.concatenate((values, values[-1:])), np.concatenate((values, values[-1:]))
+        edges = np.linspace(start, stop, self.points + 1)
+        #the setting in effect at the beginning of each point and all the ones that start within it
+        first = np.clip(np.searchsorted(starts, edges[:-1], side = 'right') - 1, 0, len(starts) - 1)
+        last = np.searchsorted(starts, edges[-1], side = 'left')
+        values = values[:max(last, first[-1] + 1)]
+        return edges, np.append(np.minimum.reduceat(values, first), values[-1]), np.append(np.maximum.reduceat(values, first), values[-1])
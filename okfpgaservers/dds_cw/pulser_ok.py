@@ -20,16 +20,27 @@ timeout = 20
 from labrad.server import LabradServer, setting, Signal
 from twisted.internet import reactor
 from twisted.internet.defer import DeferredLock, inlineCallbacks, returnValue, Deferred
-from twisted.internet.threads import deferToThread
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
 import time
 from hardwareConfiguration import hardwareConfiguration
 from sequence import Sequence
+from validation import SequenceValidator
+from compilecache import CompileCache
+from commandqueue import CommandQueue
 from dds import DDS
 from api import api
 from linetrigger import LineTrigger
+from sequencewatch import SequenceWatch
+from timetagstream import TimetagStream
+from timingprofile import TimingProfile
+from sequencebank import SequenceBank
+from pmtstream import PMTStream
+from remotedds import ConnectionPool, RemoteDDS
 import numpy
+from labrad.units import WithUnit
 
-class Pulser(DDS, LineTrigger, LabradServer):
+class Pulser(DDS, LineTrigger, SequenceWatch, TimetagStream, TimingProfile, SequenceBank, PMTStream, LabradServer):
     
     name = 'DDS_CW'
     onSwitch = Signal(611051, 'signal: switch toggled', '(ss)')
@@ -50,9 +61,21 @@ class Pulser(DDS, LineTrigger, LabradServer):
         self.sequenceTimeRange = hardwareConfiguration.sequenceTimeRange
         self.haveSecondPMT = hardwareConfiguration.secondPMT
         self.haveDAC = hardwareConfiguration.DAC
-        self.inCommunication = DeferredLock()
+        self.fpga = CommandQueue() #all the communication with the board goes through the queue
+        self.uploadLock = DeferredLock() #serializes uploading the sequences
         self.clear_next_pmt_counts = 0
+        self.lastTTLProgram = None
+        self.uploadStatistics = (0, 0)
+        self.compileCache = CompileCache(getattr(hardwareConfiguration, 'compileCacheSize', 50 * 2**20))
+        self.compilePool = ThreadPool(1, getattr(hardwareConfiguration, 'compileThreads', 4), 'sequence compilation') #compiles the sequences off the reactor thread
+        self.compilePool.start()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.compilePool.stop)
         LineTrigger.initialize(self)
+        SequenceWatch.initialize(self)
+        TimetagStream.initialize(self)
+        TimingProfile.initialize(self)
+        SequenceBank.initialize(self)
+        PMTStream.initialize(self)
         self.initializeBoard()
         yield self.initializeRemote()
         self.initializeSettings()
@@ -63,6 +86,9 @@ class Pulser(DDS, LineTrigger, LabradServer):
         connected = self.api.connectOKBoard()
         if not connected:
             raise Exception ("Pulser Not Found")
+        #the board was just programmed, forget what the rams held
+        self.lastTTLProgram = None
+        self.ddsBuffers = {}
             
     def initializeSettings(self):
         for channel in self.channelDict.itervalues():
@@ -76,15 +102,17 @@ class Pulser(DDS, LineTrigger, LabradServer):
     @inlineCallbacks
     def initializeRemote(self):
         self.remoteConnections = {}
-        if len(self.remoteChannels):
-            from labrad.wrappers import connectAsync
-            for name,rc in self.remoteChannels.iteritems():
-                try:
-                    self.remoteConnections[name] = yield connectAsync(rc.ip)
-                    print 'Connected to {}'.format(name)
-                except:
-                    print 'Not Able to connect to {}'.format(name)
-                    self.remoteConnections[name] = None
+        pools = {} #the remotes on the same host share its connections
+        for name,rc in self.remoteChannels.iteritems():
+            pool = pools.setdefault(rc.ip, ConnectionPool(rc.ip, getattr(rc, 'connections', 1), getattr(hardwareConfiguration, 'remoteReconnectDelay', (1.0, 60.0))))
+            pool.size = max(pool.size, getattr(rc, 'connections', 1))
+            self.remoteConnections[name] = RemoteDDS(name, rc, pool)
+        for name,remote in self.remoteConnections.iteritems():
+            connected = yield remote.connect()
+            if connected:
+                print 'Connected to {}'.format(name)
+            else:
+                print 'Not Able to connect to {}'.format(name)
 
     @setting(0, "New Sequence", returns = '')
     def newSequence(self, c):
@@ -97,41 +125,93 @@ class Pulser(DDS, LineTrigger, LabradServer):
     def programSequence(self, c, sequence):
         """
         Programs Pulser with the current sequence.
+        A sequence compiled before is taken from the compile cache and only its compilation is skipped, the program is
+        uploaded in full unless incrementalTTLUpload and incrementalDDSUpload are enabled in the hardware configuration.
         """
         sequence = c.get('sequence')
         if not sequence: raise Exception ("Please create new sequence first")
-        dds,ttl = sequence.progRepresentation()
-        yield self.inCommunication.acquire()
-        yield deferToThread(self.api.programBoard, ttl)
-        if dds is not None: yield self._programDDSSequence(dds)
-        self.inCommunication.release()
+        self.traceSequence()
+        programStart = time.time()
+        compiled = yield self._compile(sequence)
+        uploaded, skipped = yield self._uploadProgram(compiled)
+        self.uploadStatistics = (uploaded, skipped)
         self.isProgrammed = True
+        self.recordSpan('program sequence', programStart, uploaded)
+    
+    @inlineCallbacks
+    def _compile(self, sequence):
+        '''
+        returns the compiled (ddsSettings, ttlProgram) of the sequence, from the cache when possible.
+        the sequence is validated first, raising all of its problems together.
+        the compilation runs in the worker pool with the dds state taken when it starts, so that other requests are served meanwhile
+        '''
+        problems = SequenceValidator(sequence, self._channelNames()).problems()
+        if problems: raise Exception('\n'.join(problem[4] for problem in problems))
+        sequence.snapshotDDS()
+        #the key has to be computed before compiling because parsing the dds adds the advance and reset switches
+        key = sequence.canonicalKey()
+        compiled = self.compileCache.get(key)
+        if compiled is None:
+            start = time.time()
+            compiled = yield deferToThreadPool(reactor, self.compilePool, sequence.progRepresentation)
+            self.recordSpan('compile', start, CompileCache.programSize(compiled))
+            self.compileCache.add(key, compiled)
+        else:
+            sequence.ddsSettings, sequence.ttlProgram = compiled
+        returnValue(compiled)
+    
+    @inlineCallbacks
+    def _uploadProgram(self, compiled):
+        '''uploads the compiled program to the board, returns the number of bytes uploaded and skipped'''
+        dds,ttl = compiled
+        yield self.uploadLock.acquire()
+        try:
+            ttlLength = self._changedTTLLength(ttl)
+            if ttlLength:
+                start = time.time()
+                yield self.fpga.run(self.api.programBoard, ttl[:ttlLength])
+                self.recordSpan('upload ttl', start, ttlLength)
+            self.lastTTLProgram = ttl
+            uploaded, skipped = ttlLength, len(ttl) - ttlLength
+            if dds is not None:
+                ddsUploaded, ddsSkipped = yield self._programDDSSequence(dds)
+                uploaded += ddsUploaded
+                skipped += ddsSkipped
+        finally:
+            self.uploadLock.release()
+        returnValue((uploaded, skipped))
+    
+    @setting(30, "Validate Sequence", returns = '*(ssvvs)')
+    def validateSequence(self, c):
+        """
+        Checks the current sequence without compiling it and returns all of its problems as (kind, channel, start, stop, message)
+        with times in seconds. The kinds are 'overlap', 'resolution', 'spacing', 'range' and 'unmatched'. Programming a sequence with problems fails.
+        """
+        sequence = c.get('sequence')
+        if not sequence: raise Exception ("Please create new sequence first")
+        return SequenceValidator(sequence, self._channelNames()).problems()
     
     @setting(2, "Start Infinite", returns = '')
     def startInfinite(self,c):
         if not self.isProgrammed: raise Exception ("No Programmed Sequence")
-        yield self.inCommunication.acquire()
-        yield deferToThread(self.api.setNumberRepeatitions, 0)
-        yield deferToThread(self.api.resetSeqCounter)
-        yield deferToThread(self.api.startLooped)
+        start = time.time()
+        yield self.fpga.batch((self.api.setNumberRepeatitions, 0), (self.api.resetSeqCounter,), (self.api.startLooped,))
+        self.recordSpan('start', start)
         self.sequenceType = 'Infinite'
-        self.inCommunication.release()
     
     @setting(3, "Complete Infinite Iteration", returns = '')
     def completeInfinite(self,c):
         if self.sequenceType != 'Infinite': raise Exception( "Not Running Infinite Sequence")
-        yield self.inCommunication.acquire()
-        yield deferToThread(self.api.startSingle)
-        self.inCommunication.release()
+        yield self.fpga.run(self.api.startSingle)
     
     @setting(4, "Start Single", returns = '')
     def start(self, c):
         if not self.isProgrammed: raise Exception ("No Programmed Sequence")
-        yield self.inCommunication.acquire()
-        yield deferToThread(self.api.resetSeqCounter)
-        yield deferToThread(self.api.startSingle)
+        start = time.time()
+        yield self.fpga.batch((self.api.resetSeqCounter,), (self.api.startSingle,))
+        self.recordSpan('start', start)
         self.sequenceType = 'One'
-        self.inCommunication.release()
+        self.watchSequence()
     
     @setting(5, 'Add TTL Pulse', channel = 's', start = 'v[s]', duration = 'v[s]')
     def addTTLPulse(self, c, channel, start, duration):
@@ -159,7 +239,34 @@ class Pulser(DDS, LineTrigger, LabradServer):
             start = pulse[1]
             duration = pulse[2]
             yield self.addTTLPulse(c, channel, start, duration)
-    
+
+    @setting(19, 'Add TTL Pulses Binary', channels = '*w', starts = '*w', durations = '*w', returns = '')
+    def addTTLPulsesBinary(self, c, channels, starts, durations):
+        """
+        Add many TTL pulses to the sequence at once. The pulses are given as arrays of hardware channel numbers,
+        start times and durations, with times in the units of the time resolution.
+        """
+        sequence = c.get('sequence')
+        if not sequence: raise Exception ("Please create new sequence first")
+        channels = numpy.asarray(channels, dtype = numpy.int64)
+        starts = numpy.asarray(starts, dtype = numpy.int64)
+        durations = numpy.asarray(durations, dtype = numpy.int64)
+        if not len(channels) == len(starts) == len(durations): raise Exception ("Channels, starts and durations must have the same length")
+        hardwareNumbers = [channel.channelnumber for channel in self.channelDict.itervalues()]
+        unknown = numpy.setdiff1d(channels, hardwareNumbers)
+        if len(unknown): raise Exception("Unknown Channel {}".format(unknown[0]))
+        minStep, maxStep = [sequence.secToStep(t) for t in self.sequenceTimeRange]
+        if not ((minStep <= starts) & (starts + durations <= maxStep)).all(): raise Exception ("Time boundaries are out of range")
+        if not (durations >= 1).all(): raise Exception ("Incorrect duration")
+        sequence.addPulses(channels, starts, durations)
+
+    @setting(20, 'Get Time Resolution', returns = 'v[s]')
+    def getTimeResolution(self, c):
+        """
+        Returns the time resolution of the pulse sequence, the unit of times for the binary settings
+        """
+        return WithUnit(self.timeResolution, 's')
+
     @setting(7, "Extend Sequence Length", timeLength = 'v[s]')
     def extendSequenceLength(self, c, timeLength):
         """
@@ -173,15 +280,17 @@ class Pulser(DDS, LineTrigger, LabradServer):
     @setting(8, "Stop Sequence")
     def stopSequence(self, c):
         """Stops any currently running sequence"""
-        yield self.inCommunication.acquire()
-        yield deferToThread(self.api.resetRam)
+        calls = [(self.api.resetRam,)]
         if self.sequenceType =='Infinite':
-            yield deferToThread(self.api.stopLooped)
+            calls.append((self.api.stopLooped,))
         elif self.sequenceType =='One':
-            yield deferToThread(self.api.stopSingle)
+            calls.append((self.api.stopSingle,))
         elif self.sequenceType =='Number':
-            yield deferToThread(self.api.stopLooped)
-        self.inCommunication.release()
+            calls.append((self.api.stopLooped,))
+        start = time.time()
+        yield self.fpga.batch(*calls)
+        self.recordSpan('stop', start)
+        self.unwatchSequence()
         self.sequenceType = None
         self.ddsLock = False
     
@@ -193,12 +302,11 @@ class Pulser(DDS, LineTrigger, LabradServer):
         if not self.isProgrammed: raise Exception ("No Programmed Sequence")
         repeatitions = int(repeatitions)
         if not 1 <= repeatitions <= (2**16 - 1): raise Exception ("Incorrect number of pulses")
-        yield self.inCommunication.acquire()
-        yield deferToThread(self.api.setNumberRepeatitions, repeatitions)
-        yield deferToThread(self.api.resetSeqCounter)
-        yield deferToThread(self.api.startLooped)
+        start = time.time()
+        yield self.fpga.batch((self.api.setNumberRepeatitions, repeatitions), (self.api.resetSeqCounter,), (self.api.startLooped,))
+        self.recordSpan('start', start)
         self.sequenceType = 'Number'
-        self.inCommunication.release()
+        self.watchSequence()
 
     @setting(10, "Human Readable TTL", returns = '*2s')
     def humanReadableTTL(self, c):
@@ -220,6 +328,30 @@ class Pulser(DDS, LineTrigger, LabradServer):
         ttl,dds = sequence.humanRepresentation()
         return dds
     
+    @setting(38, "Timeline TTL", returns = '(*s*v*v)')
+    def timelineTTL(self, c):
+        """
+        Returns the ttl pulses of the programmed sequence as the columns (channels, starts, stops) with times in seconds
+        """
+        sequence = c.get('sequence')
+        if not sequence: raise Exception ("Please create new sequence first")
+        timeline = sequence.timeline(self._channelNames())
+        return (timeline.ttlChannels.tolist(), timeline.ttlStarts, timeline.ttlStops)
+    
+    @setting(39, "Timeline DDS", returns = '(*s*v*v*v*v)')
+    def timelineDDS(self, c):
+        """
+        Returns the dds settings of the programmed sequence as the columns (channels, starts, stops, frequencies, amplitudes)
+        with times in seconds, frequencies in MHz and amplitudes in dBm
+        """
+        sequence = c.get('sequence')
+        if not sequence: raise Exception ("Please create new sequence first")
+        timeline = sequence.timeline(self._channelNames())
+        return (timeline.ddsChannels.tolist(), timeline.ddsStarts, timeline.ddsStops, timeline.ddsFrequencies, timeline.ddsAmplitudes)
+    
+    def _channelNames(self):
+        return dict((channel.channelnumber, name) for name,channel in self.channelDict.iteritems())
+    
     @setting(12, 'Get Channels', returns = '*(sw)')
     def getChannels(self, c):
         """
@@ -244,9 +376,7 @@ class Pulser(DDS, LineTrigger, LabradServer):
             channel.manualstate = state
         else:
             state = channel.manualstate
-        yield self.inCommunication.acquire()
-        yield deferToThread(self.api.setManual, channelNumber, self.cnot(channel.manualinv, state))
-        self.inCommunication.release()
+        yield self.fpga.run(self.api.setManual, channelNumber, self.cnot(channel.manualinv, state))
         if state:
             self.notifyOtherListeners(c,(channelName,'ManualOn'), self.onSwitch)
         else:
@@ -265,9 +395,7 @@ class Pulser(DDS, LineTrigger, LabradServer):
             channel.autoinv = invert
         else:
             invert = channel.autoinv
-        yield self.inCommunication.acquire()
-        yield deferToThread(self.api.setAuto, channelNumber, invert)
-        self.inCommunication.release()
+        yield self.fpga.run(self.api.setAuto, channelNumber, invert)
         self.notifyOtherListeners(c,(channelName,'Auto'), self.onSwitch)
 
     @setting(15, 'Get State', channelName = 's', returns = '(bbbb)')
@@ -283,27 +411,38 @@ class Pulser(DDS, LineTrigger, LabradServer):
     @setting(16, 'Wait Sequence Done', timeout = 'v', returns = 'b')
     def waitSequenceDone(self, c, timeout = None):
         """
-        Returns true if the sequence has completed within a timeout period
+        Returns true if the sequence has completed within a timeout period.
+        Instead of waiting, clients can also listen to the 'signal: sequence done'.
         """
         if timeout is None: timeout = self.sequenceTimeRange[1]
-        requestCalls = int(timeout / 0.050 ) #number of request calls
-        for i in range(requestCalls):
-            yield self.inCommunication.acquire()
-            done = yield deferToThread(self.api.isSeqDone)
-            self.inCommunication.release()
-            if done: returnValue(True)
-            yield self.wait(0.050)
-        returnValue(False)
+        start = time.time()
+        done = yield self.sequenceDone(timeout)
+        self.recordSpan('wait', start)
+        returnValue(done)
     
     @setting(17, 'Repeatitions Completed', returns = 'w')
     def repeatitionsCompleted(self, c):
         """Check how many repeatitions have been completed in for the infinite or number modes"""
-        yield self.inCommunication.acquire()
-        completed = yield deferToThread(self.api.howManySequencesDone)
-        self.inCommunication.release()
+        completed = yield self.fpga.query(self.api.howManySequencesDone)
         returnValue(completed)
 
     
+    @setting(18, 'Get Upload Statistics', returns = '(ww)')
+    def getUploadStatistics(self, c):
+        """
+        Returns the number of bytes uploaded and the number of bytes skipped because they were already on the board
+        for the last programmed sequence
+        """
+        return self.uploadStatistics
+    
+    @setting(29, 'Get Compile Cache Statistics', returns = '(wwww)')
+    def getCompileCacheStatistics(self, c):
+        """
+        Returns the number of hits and misses of the compiled sequence cache, the number of cached sequences and their total size in bytes
+        """
+        cache = self.compileCache
+        return (cache.hits, cache.misses, len(cache), cache.size)
+    
     @setting(21, 'Set Mode', mode = 's', returns = '')
     def setMode(self, c, mode):
         """
@@ -315,15 +454,12 @@ class Pulser(DDS, LineTrigger, LabradServer):
         if mode not in self.collectionTime.keys(): raise Exception("Incorrect mode")
         self.collectionMode = mode
         countRate = self.collectionTime[mode]
-        yield self.inCommunication.acquire()
         if mode == 'Normal':
             #set the mode on the device and set update time for normal mode
-            yield deferToThread(self.api.setModeNormal)
-            yield deferToThread(self.api.setPMTCountRate, countRate)
+            yield self.fpga.batch((self.api.setModeNormal,), (self.api.setPMTCountRate, countRate))
         elif mode == 'Differential':
-            yield deferToThread(self.api.setModeDifferential)
+            yield self.fpga.run(self.api.setModeDifferential)
         self.clear_next_pmt_counts = 3 #assign to clear next two counts
-        self.inCommunication.release()
     
     @setting(22, 'Set Collection Time', new_time = 'v', mode = 's', returns = '')
     def setCollectTime(self, c, new_time, mode):
@@ -335,10 +471,8 @@ class Pulser(DDS, LineTrigger, LabradServer):
         if mode not in self.collectionTime.keys(): raise("Incorrect mode")
         if mode == 'Normal':
             self.collectionTime[mode] = new_time
-            yield self.inCommunication.acquire()
-            yield deferToThread(self.api.setPMTCountRate, new_time)
+            yield self.fpga.run(self.api.setPMTCountRate, new_time)
             self.clear_next_pmt_counts = 3 #assign to clear next two counts
-            self.inCommunication.release()
         elif mode == 'Differential':
             self.collectionTime[mode] = new_time
             self.clear_next_pmt_counts = 3 #assign to clear next two counts
@@ -352,9 +486,7 @@ class Pulser(DDS, LineTrigger, LabradServer):
         """
         Resets the FIFO on board, deleting all queued counts
         """
-        yield self.inCommunication.acquire()
-        yield deferToThread(self.api.resetFIFONormal)
-        self.inCommunication.release()
+        yield self.fpga.run(self.api.resetFIFONormal)
     
     @setting(25, 'Get PMT Counts', returns = '*(vsv)')
     def getALLCounts(self, c):
@@ -364,111 +496,102 @@ class Pulser(DDS, LineTrigger, LabradServer):
         mode when 866 is off. s2 is the approximate time of acquisition.
         NOTE: For some reason, FGPA ReadFromBlockPipeOut never time outs, so can not implement requesting more packets than
         currently stored because it may hang the device.
+        While the PMT stream is running, returns the counts recorded since the previous call in this context instead.
         """
-        yield self.inCommunication.acquire()
-        countlist = yield deferToThread(self.doGetAllCounts)
-        self.inCommunication.release()
+        if self.pmt_streaming: returnValue(self.streamedPMTCounts(c))
+        start = time.time()
+        countlist = yield self.fpga.run(self.doGetAllCounts)
+        self.recordSpan('read pmt counts', start, 4 * len(countlist))
         returnValue(countlist)
     
     @setting(26, 'Get Readout Counts', returns = '*v')
     def getReadoutCounts(self, c):
-        yield self.inCommunication.acquire()
-        countlist = yield deferToThread(self.doGetReadoutCounts)
-        self.inCommunication.release()
+        start = time.time()
+        countlist = yield self.fpga.run(self.doGetReadoutCounts)
+        self.recordSpan('read readout counts', start, 4 * len(countlist))
         returnValue(countlist)
         
     @setting(27, 'Reset Readout Counts')
     def resetReadoutCounts(self, c):
-        yield self.inCommunication.acquire()
-        yield deferToThread(self.api.resetFIFOReadout)
-        self.inCommunication.release()
+        yield self.fpga.run(self.api.resetFIFOReadout)
 
     #debugging settings
     @setting(90, 'Internal Reset DDS', returns = '')
     def internal_reset_dds(self, c):
-        yield self.inCommunication.acquire()
-        yield deferToThread(self.api.resetAllDDS)
-        self.inCommunication.release()
+        yield self.fpga.run(self.api.resetAllDDS)
         
     @setting(91, 'Internal Advance DDS', returns = '')
     def internal_advance_dds(self, c):
-        yield self.inCommunication.acquire()
-        yield deferToThread(self.api.advanceAllDDS)
-        self.inCommunication.release()
+        yield self.fpga.run(self.api.advanceAllDDS)
     
     @setting(92, "Reinitialize DDS", returns = '')
     def reinitializeDDS(self, c):
         """
         Reprograms the DDS chip to its initial state
         """
-        yield self.inCommunication.acquire()
-        yield deferToThread(self.api.initializeDDS)
-        self.inCommunication.release()
+        yield self.fpga.run(self.api.initializeDDS)
+        self.ddsBuffers = {}
         
+    def _changedTTLLength(self, ttl):
+        '''
+        Returns the length of the beginning of the ttl program that has to be uploaded.
+        The pulse ram is written from the start, so when the program has the same length as the one on the board
+        only the lines up to the last changed one are uploaded.
+        '''
+        last = self.lastTTLProgram
+        if not getattr(hardwareConfiguration, 'incrementalTTLUpload', False) or last is None or len(last) != len(ttl): return len(ttl)
+        lineLength = 8 #each line is the time and the channel state, 4 bytes each
+        new = numpy.fromstring(ttl, dtype = numpy.uint8).reshape(-1, lineLength)
+        old = numpy.fromstring(last, dtype = numpy.uint8).reshape(-1, lineLength)
+        changed = numpy.nonzero((new != old).any(axis = 1))[0]
+        if not len(changed): return 0
+        return int(lineLength * (changed[-1] + 1))
+    
     def doGetAllCounts(self):
-        inFIFO = self.api.getNormalTotal()
-        reading = self.api.getNormalCounts(inFIFO)
-        split = self.split_len(reading, 4)
-        countlist = map(self.infoFromBuf, split)
-        countlist = map(self.convertKCperSec, countlist)
-        countlist = self.appendTimes(countlist, time.time())
+        reading, timeLast = self.doReadNormalCounts()
+        countlist = self.countRates(reading, timeLast)
         countlist = self.clear_pmt_counts(countlist)
         return countlist
 
     def clear_pmt_counts(self, l):
         '''removes clear_next_pmt_counts count from the list'''
-        try:
-            while self.clear_next_pmt_counts:
-                cleared = l.pop(0)
-                self.clear_next_pmt_counts -= 1
-            return l
-        except IndexError:
-            return []
+        cleared = min(self.clear_next_pmt_counts, len(l))
+        self.clear_next_pmt_counts -= cleared
+        return l[cleared:]
     
     def doGetReadoutCounts(self):
         inFIFO = self.api.getReadoutTotal()
         reading = self.api.getReadoutCounts(inFIFO)
-        split = self.split_len(reading, 4)
-        countlist = map(self.infoFromBuf_readout, split)
-        return countlist
+        return self.countsFromBuf(reading).astype(numpy.float64)
     
     @staticmethod
-    def infoFromBuf(buf):
-        #converts the received buffer into useful information
-        #the most significant digit of the buffer indicates wheter 866 is on or off
-        count = 65536*(256*ord(buf[1])+ord(buf[0]))+(256*ord(buf[3])+ord(buf[2]))
-        if count >= 2**31:
-            status = 'OFF'
-            count = count % 2**31
-        else:
-            status = 'ON'
-        return [count, status]
-    
-    #should make nicer by combining with above.
-    @staticmethod
-    def infoFromBuf_readout(buf):
-        count = 65536*(256*ord(buf[1])+ord(buf[0]))+(256*ord(buf[3])+ord(buf[2]))
-        return count
-    
-    def convertKCperSec(self, inp):
-        [rawCount,typ] = inp
-        countKCperSec = float(rawCount) / self.collectionTime[self.collectionMode] / 1000.
-        return [countKCperSec, typ]
-        
-    def appendTimes(self, l, timeLast):
-        #in the case that we received multiple PMT counts, uses the current time
-        #and the collectionTime to guess the arrival time of the previous readings
-        #i.e ( [[1,2],[2,3]] , timeLAst = 1.0, normalupdatetime = 0.1) ->
-        # ( [(1,2,0.9),(2,3,1.0)])
+    def countsFromBuf(buf):
+        '''
+        converts the received buffer into an array of the 32 bit counts.
+        each count is sent as the most significant 16 bit word followed by the least significant one,
+        so the words of the little endian view of the buffer are swapped.
+        '''
+        words = numpy.frombuffer(buf, dtype = '<u4', count = len(buf) // 4)
+        return (words << 16) | (words >> 16)
+    
+    def countRates(self, buf, timeLast):
+        '''converts the received buffer into the list of (count rate in KC/SEC, status, time) of the PMT counts'''
+        rates, off, times = self.countArrays(buf, timeLast)
+        status = numpy.where(off, 'OFF', 'ON')
+        return zip(rates.tolist(), status.tolist(), times.tolist())
+    
+    def countArrays(self, buf, timeLast):
+        '''
+        converts the received buffer into the arrays of the count rates in KC/SEC, whether 866 is off and the times of the PMT counts.
+        the most significant bit of each count indicates whether 866 is on or off.
+        in the case of multiple PMT counts, uses the current time and the collectionTime to guess the arrival time of the previous readings
+        '''
+        counts = self.countsFromBuf(buf)
         collectionTime = self.collectionTime[self.collectionMode]
-        for i in range(len(l)):
-            l[-i - 1].append(timeLast - i * collectionTime)
-            l[-i - 1] = tuple(l[-i - 1])
-        return l
-    
-    def split_len(self,seq, length):
-        '''useful for splitting a string in length-long pieces'''
-        return [seq[i:i+length] for i in range(0, len(seq), length)]
+        rates = (counts & 0x7fffffff) / collectionTime / 1000.
+        off = counts >= 2**31
+        times = timeLast - collectionTime * numpy.arange(len(counts))[::-1]
+        return rates, off, times
     
     @setting(28, 'Get Collection Mode', returns = 's')
     def getMode(self, c):
@@ -477,23 +600,22 @@ class Pulser(DDS, LineTrigger, LabradServer):
     @setting(31, "Reset Timetags")
     def resetTimetags(self, c):
         """Reset the time resolved FIFO to clear any residual timetags"""
-        yield self.inCommunication.acquire()
-        yield deferToThread(self.api.resetFIFOResolved)
-        self.inCommunication.release()
+        yield self.fpga.run(self.api.resetFIFOResolved)
     
     @setting(32, "Get Timetags", returns = '*v')
     def getTimetags(self, c):
         """Get the time resolved timetags"""
-        yield self.inCommunication.acquire()
-        counted = yield deferToThread(self.api.getResolvedTotal)
-        raw = yield deferToThread(self.api.getResolvedCounts, counted)
-        self.inCommunication.release()
-        arr = numpy.fromstring(raw, dtype = numpy.uint16)
-        del(raw)
-        arr = arr.reshape(-1,2)
-        timetags =( 65536 * arr[:,0] + arr[:,1]) * self.timeResolvedResolution
+        if self.timetag_streaming: raise Exception("Timetags are being streamed")
+        start = time.time()
+        raw = yield self.fpga.run(self.doGetTimetags)
+        self.recordSpan('read timetags', start, len(raw))
+        timetags = self.countsFromBuf(raw) * self.timeResolvedResolution
         returnValue(timetags)
     
+    def doGetTimetags(self):
+        counted = self.api.getResolvedTotal()
+        return self.api.getResolvedCounts(counted)
+    
     @setting(33, "Get TimeTag Resolution", returns = 'v')
     def getTimeTagResolution(self, c):
         return self.timeResolvedResolution
@@ -502,20 +624,17 @@ class Pulser(DDS, LineTrigger, LabradServer):
     @setting(36, 'Get Secondary PMT Counts', returns = '*(vsv)')
     def getAllSecondaryCounts(self, c):
         if not self.haveSecondPMT: raise Exception ("No Second PMT")
-        yield self.inCommunication.acquire()
-        countlist = yield deferToThread(self.doGetAllSecondaryCounts)
-        self.inCommunication.release()
+        start = time.time()
+        countlist = yield self.fpga.run(self.doGetAllSecondaryCounts)
+        self.recordSpan('read secondary pmt counts', start, 4 * len(countlist))
         returnValue(countlist)
             
     def doGetAllSecondaryCounts(self):
         if not self.haveSecondPMT: raise Exception ("No Second PMT")
         inFIFO = self.api.getSecondaryNormalTotal()
         reading = self.api.getSecondaryNormalCounts(inFIFO)
-        split = self.split_len(reading, 4)
-        countlist = map(self.infoFromBuf, split)
-        countlist = map(self.convertKCperSec, countlist)
-        countlist = self.appendTimes(countlist, time.time())
-        return countlist        
+        countlist = self.countRates(reading, time.time())
+        return countlist
 
 
     def wait(self, seconds, result=None):
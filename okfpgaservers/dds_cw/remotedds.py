@@ -0,0 +1,122 @@
+import time
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred, DeferredLock
+
+class ConnectionPool(object):
+    """
+    Asynchronous LabRAD connections to one host, opened on demand up to the size of the pool.
+    Broken connections are discarded and reopened by the next request. After a failed attempt to connect,
+    no new attempt is made before the backoff delay, which doubles with every consecutive failure.
+    """
+    def __init__(self, host, size, backoff):
+        self.host = host
+        self.size = size
+        self.minDelay, self.maxDelay = backoff
+        self.delay = self.minDelay
+        self.retryTime = 0
+        self.idle = []
+        self.opened = 0
+        self.waiting = []
+
+    @inlineCallbacks
+    def acquire(self):
+        '''returns an idle connection, or a new one, or None if the host can not be reached'''
+        if self.idle:
+            returnValue(self.idle.pop())
+        if self.opened >= self.size:
+            d = Deferred()
+            self.waiting.append(d)
+            cxn = yield d
+            returnValue(cxn)
+        if time.time() < self.retryTime:
+            returnValue(None)
+        cxn = yield self._connect()
+        returnValue(cxn)
+
+    @inlineCallbacks
+    def _connect(self):
+        from labrad.wrappers import connectAsync
+        self.opened += 1
+        try:
+            cxn = yield connectAsync(self.host)
+        except Exception:
+            self.opened -= 1
+            self.retryTime = time.time() + self.delay
+            self.delay = min(2 * self.delay, self.maxDelay)
+            self._wakeWaiter()
+            cxn = None
+        else:
+            self.delay = self.minDelay
+        returnValue(cxn)
+
+    def release(self, cxn):
+        '''returns a working connection to the pool'''
+        if self.waiting:
+            self.waiting.pop(0).callback(cxn)
+        else:
+            self.idle.append(cxn)
+
+    def discard(self, cxn):
+        '''drops a connection that failed'''
+        self.opened -= 1
+        try:
+            cxn.disconnect()
+        except Exception:
+            pass
+        self._wakeWaiter()
+
+    def _wakeWaiter(self):
+        '''lets the next waiting request try to connect in place of the connection that was lost'''
+        if self.waiting:
+            self.acquire().chainDeferred(self.waiting.pop(0))
+
+class RemoteDDS(object):
+    """
+    Programs the DDS channels of one remote server through the connection pool of its host.
+    The reset and program of one upload are never interleaved with another upload to the same remote.
+    """
+    def __init__(self, name, info, pool):
+        self.name = name
+        self.server = info.server
+        self.reset = info.reset
+        self.program = info.program
+        self.pool = pool
+        self.lock = DeferredLock()
+
+    @inlineCallbacks
+    def connect(self):
+        '''opens a connection ahead of the first upload, returns whether the host could be reached'''
+        cxn = yield self.pool.acquire()
+        if cxn is not None:
+            self.pool.release(cxn)
+        returnValue(cxn is not None)
+
+    @inlineCallbacks
+    def programChannels(self, channels):
+        '''
+        resets the remote and programs it with the list of (channel number, buf) in a single call.
+        returns the time the upload took in seconds, or None if the remote was not programmed
+        '''
+        yield self.lock.acquire()
+        try:
+            start = time.time()
+            latency = None
+            cxn = yield self.pool.acquire()
+            if cxn is None:
+                print 'Not programing remote channel {}'.format(self.name)
+            else:
+                try:
+                    server = cxn.servers[self.server]
+                    yield server[self.reset]()
+                    yield server[self.program](channels)
+                except (KeyError,AttributeError):
+                    self.pool.release(cxn)
+                    print 'Not programing remote channel {}'.format(self.name)
+                except Exception:
+                    self.pool.discard(cxn)
+                    raise
+                else:
+                    self.pool.release(cxn)
+                    latency = time.time() - start
+        finally:
+            self.lock.release()
+        returnValue(latency)
@@ -1,7 +1,13 @@
 import numpy
-import array
+import hashlib
 from hardwareConfiguration import hardwareConfiguration
 from decimal import Decimal
+from timebase import TimeBase
+from timeline import Timeline
+
+#layout of a single dds setting in the buffer, each part is sent least significant byte first
+ddsWord = numpy.dtype([('high', '<u2'), ('low', '<u2')])
+ddsCoherentWord = numpy.dtype([('phase', '<u2'), ('amplitude', '<u2'), ('frequency', '<u4')])
 
 class Sequence():
     """Sequence for programming pulses"""
@@ -9,16 +15,17 @@ class Sequence():
         self.parent = parent
         self.channelTotal = hardwareConfiguration.channelTotal
         self.timeResolution = Decimal(hardwareConfiguration.timeResolution)
+        self.timeBase = TimeBase(hardwareConfiguration.timeResolution)
         self.MAX_SWITCHES = hardwareConfiguration.maxSwitches
         self.resetstepDuration = hardwareConfiguration.resetstepDuration
-        #dictionary in the form time:which channels to switch
+        #table of switches stored as parallel columns of (time, channel, value)
         #time is expressed as timestep with the given resolution
-        #which channels to switch is a channelTotal-long array with 1 to switch ON, -1 to switch OFF, 0 to do nothing
-        self.switchingTimes = {0:numpy.zeros(self.channelTotal, dtype = numpy.int8)} 
-        self.switches = 1 #keeps track of how many switches are to be performed (same as the number of keys in the switching Times dictionary"
+        #value is 1 to switch ON, -1 to switch OFF, 0 to do nothing
+        self.switchingTimes = SwitchTable(self.channelTotal)
         #dictionary for storing information about dds switches, in the format:
         #timestep: {channel_name: integer representing the state}
         self.ddsSettingList = []
+        self.ddsState = None #dds state of the server the sequence is compiled with, taken by snapshotDDS
         self.advanceDDS = hardwareConfiguration.channelDict['AdvanceDDS'].channelnumber
         self.resetDDS = hardwareConfiguration.channelDict['ResetDDS'].channelnumber
     
@@ -33,6 +40,20 @@ class Sequence():
         self._addNewSwitch(start, channel, 1)
         self._addNewSwitch(start + duration, channel, -1)
     
+    def addPulses(self, channels, starts, durations):
+        """adding an array of TTL pulses at once, times are in time steps"""
+        timeSteps = numpy.concatenate((starts, starts + durations))
+        chans = numpy.concatenate((channels, channels))
+        values = numpy.concatenate((numpy.ones(len(starts), dtype = numpy.int8), -numpy.ones(len(starts), dtype = numpy.int8)))
+        self._addNewSwitches(timeSteps, chans, values)
+    
+    def addDDSPulses(self, names, starts, stops, nums, numsOff):
+        """adding dds pulses at once, in the same order as adding the start and stop of each pulse in turn, times are in time steps"""
+        entries = [None] * (2 * len(nums))
+        entries[::2] = zip(names, starts.tolist(), nums, ['start'] * len(nums))
+        entries[1::2] = zip(names, stops.tolist(), numsOff, ['stop'] * len(nums))
+        self.ddsSettingList.extend(entries)
+    
     def extendSequenceLength(self, timeLength):
         """Allows to extend the total length of the sequence"""
         timeLength = self.secToStep(timeLength)
@@ -40,11 +61,7 @@ class Sequence():
 
     def secToStep(self, sec):
         '''converts seconds to time steps'''
-        start = '{0:.9f}'.format(sec) #round to nanoseconds
-        start = Decimal(start) #convert to decimal 
-        step = ( start / self.timeResolution).to_integral_value()
-        step = int(step)
-        return step
+        return self.timeBase.secToStep(sec)
     
     def numToHex(self, number):
         '''converts the number to the hex representation for a total of 32 bits
@@ -52,15 +69,23 @@ class Sequence():
         a,b = number // 65536, number % 65536
         return str(numpy.uint16([a,b]).data)
 
+    @property
+    def switches(self):
+        '''number of switches to be performed, same as the number of distinct switching times'''
+        return len(self.switchingTimes)
+
     def _addNewSwitch(self, timeStep, chan, value):
-        if self.switchingTimes.has_key(timeStep):
-            if self.switchingTimes[timeStep][chan]: raise Exception ('Double switch at time {} for channel {}'.format(timeStep, chan))
-            self.switchingTimes[timeStep][chan] = value
-        else:
+        if self.switchingTimes.isSwitched(timeStep, chan): raise Exception ('Double switch at time {} for channel {}'.format(timeStep, chan))
+        if not self.switchingTimes.hasTime(timeStep):
             if self.switches == self.MAX_SWITCHES: raise Exception("Exceeded maximum number of switches {}".format(self.switches))
-            self.switchingTimes[timeStep] = numpy.zeros(self.channelTotal, dtype = numpy.int8)
-            self.switches += 1
-            self.switchingTimes[timeStep][chan] = value
+        self.switchingTimes.add(timeStep, chan, value)
+    
+    def _addNewSwitches(self, timeSteps, chans, values):
+        '''vectorized version of _addNewSwitch for arrays of non-zero switches'''
+        double = self.switchingTimes.firstDoubleSwitch(timeSteps, chans)
+        if double is not None: raise Exception ('Double switch at time {} for channel {}'.format(*double))
+        if self.switchingTimes.timesAfterAdding(timeSteps) > self.MAX_SWITCHES: raise Exception("Exceeded maximum number of switches {}".format(self.MAX_SWITCHES))
+        self.switchingTimes.extend(timeSteps, chans, values)
     
     def progRepresentation(self, parse = True):
         if parse:
@@ -68,39 +93,62 @@ class Sequence():
             self.ttlProgram = self.parseTTL()
         return self.ddsSettings, self.ttlProgram
     
+    def snapshotDDS(self):
+        '''
+        records the current dds state of the server for compiling, so that the compilation does not depend on
+        changes made to the dds channels while it runs
+        '''
+        if self.userAddedDDS():
+            self.ddsState = self.parent._getCurrentDDS()
+    
+    def currentDDS(self):
+        '''returns the recorded dds state, or the current one if no snapshot was taken'''
+        if self.ddsState is not None: return self.ddsState
+        return self.parent._getCurrentDDS()
+    
+    def canonicalKey(self):
+        '''
+        Returns the hash of the sorted ttl switches and dds settings together with the current dds state.
+        Sequences with the same key compile into the same program.
+        '''
+        digest = hashlib.sha1()
+        times, channels, values = self.switchingTimes.columns()
+        order = numpy.lexsort((values, channels, times))
+        for column in (times, channels, values):
+            digest.update(column[order].tostring())
+        if self.userAddedDDS():
+            #same order as when parsing, the order of settings at the same time matters
+            entries = sorted(self.ddsSettingList, key = lambda t: t[1] )
+            names, starts, nums, typs = zip(*entries)
+            stateNames, stateNums = zip(*sorted(self.currentDDS().iteritems()))
+            digest.update('\x00'.join(names + stateNames))
+            digest.update(numpy.array(nums + stateNums, dtype = numpy.uint64).tostring())
+            digest.update(numpy.array(starts, dtype = numpy.int64).tostring())
+            digest.update((numpy.array(typs) == 'start').tostring())
+        return digest.digest()
+    
     def userAddedDDS(self):
         return bool(len(self.ddsSettingList))
     
     def parseDDS(self):
         if not self.userAddedDDS(): return None
-        state = self.parent._getCurrentDDS()
+        state = self.currentDDS()
+        names = state.keys()
+        column = dict((name, i) for i,name in enumerate(names))
         pulses_end = {}.fromkeys(state, (0, 'stop')) #time / boolean whether in a middle of a pulse 
-        dds_program = {}.fromkeys(state, '')
+        #the program is a (steps x channels) matrix of states, only the changes are recorded in the form
+        #(step, column): integer representing the state, each step carries over the states of the previous one
+        changes = dict(((0, column[name]), num) for name,num in state.iteritems())
+        steps = 0 #number of completed steps
         lastTime = 0
         entries = sorted(self.ddsSettingList, key = lambda t: t[1] ) #sort by starting time
         possibleError = (0,'')
-        while True:
-            try:
-                name,start,num,typ = entries.pop(0)
-            except IndexError:
-                if start  == lastTime:
-                    #still have unprogrammed entries
-                    self.addToProgram(dds_program, state)
-                    self._addNewSwitch(lastTime,self.advanceDDS,1)
-                    self._addNewSwitch(lastTime + self.resetstepDuration,self.advanceDDS,-1)
-                #add termination
-                for name in dds_program.iterkeys():
-                    dds_program[name] +=  '\x00\x00'
-                #at the end of the sequence, reset dds
-                lastTTL = max(self.switchingTimes.keys())
-                self._addNewSwitch(lastTTL ,self.resetDDS, 1 )
-                self._addNewSwitch(lastTTL + self.resetstepDuration ,self.resetDDS,-1)
-                return dds_program
+        for name,start,num,typ in entries:
             end_time, end_typ =  pulses_end[name]
             if start > lastTime:
                 #the time has advanced, so need to program the previous state
                 if possibleError[0] == lastTime and len(possibleError[1]): raise Exception(possibleError[1]) #if error exists and belongs to that time
-                self.addToProgram(dds_program, state)
+                steps += 1
                 if not lastTime == 0:
                     self._addNewSwitch(lastTime,self.advanceDDS,1)
                     self._addNewSwitch(lastTime + self.resetstepDuration,self.advanceDDS,-1)
@@ -109,39 +157,67 @@ class Sequence():
                 #overwite only when extending pulse
                 if end_typ == 'stop' and typ == 'start':
                     possibleError = (0,'')
-                    state[name] = num
+                    changes[steps, column[name]] = num
                     pulses_end[name] = (start, typ)
                 elif end_typ == 'start' and typ == 'stop':
                     possibleError = (0,'')
             elif end_typ == typ:
                 possibleError = (start,'Found Overlap Of Two Pules for channel {}'.format(name))
-                state[name] = num
+                changes[steps, column[name]] = num
                 pulses_end[name] = (start, typ)
             else:
-                state[name] = num
+                changes[steps, column[name]] = num
                 pulses_end[name] = (start, typ)
-
-    def addToProgram(self, prog, state):
-        for name,num in state.iteritems():
-            if not hardwareConfiguration.ddsDict[name].phase_coherent_model:
-                buf = self.parent._intToBuf(num)
-            else:  
-                buf = self.parent._intToBuf_coherent(num)
-            prog[name] += buf
+        if start  == lastTime:
+            #still have unprogrammed entries
+            steps += 1
+            self._addNewSwitch(lastTime,self.advanceDDS,1)
+            self._addNewSwitch(lastTime + self.resetstepDuration,self.advanceDDS,-1)
+        #at the end of the sequence, reset dds
+        lastTTL = self.switchingTimes.lastTime()
+        self._addNewSwitch(lastTTL ,self.resetDDS, 1 )
+        self._addNewSwitch(lastTTL + self.resetstepDuration ,self.resetDDS,-1)
+        states = self.ddsStates(steps, len(names), changes)
+        return dict((name, self.ddsToBuf(name, states[:, column[name]])) for name in names)
+    
+    def ddsStates(self, steps, channels, changes):
+        '''
+        builds the (steps x channels) matrix of dds states out of the recorded changes
+        each step keeps the states of the previous one for the channels that did not change
+        '''
+        states = numpy.zeros((steps, channels), dtype = numpy.uint64)
+        changed = numpy.zeros((steps, channels), dtype = numpy.int64)
+        positions = [position for position in changes.iterkeys() if position[0] < steps]
+        rows, cols = numpy.array(positions, dtype = numpy.int64).reshape(-1, 2).transpose()
+        states[rows, cols] = numpy.array([changes[position] for position in positions], dtype = numpy.uint64)
+        changed[rows, cols] = rows
+        #for every step the row of the last change of each channel
+        lastChange = numpy.maximum.accumulate(changed, axis = 0)
+        return states[lastChange, numpy.arange(channels)]
+    
+    def ddsToBuf(self, name, nums):
+        '''encodes the array of dds states of the channel into the buffer string for dds programming, adding the termination'''
+        if not hardwareConfiguration.ddsDict[name].phase_coherent_model:
+            words = numpy.zeros(len(nums), dtype = ddsWord)
+            words['high'], words['low'] = nums >> 16, nums & 0xffff
+        else:
+            words = numpy.zeros(len(nums), dtype = ddsCoherentWord)
+            phase_ampl_num = nums >> 32
+            words['phase'], words['amplitude'] = phase_ampl_num >> 16, phase_ampl_num & 0xffff
+            words['frequency'] = nums & 0xffffffff
+        return words.tostring() + '\x00\x00'
         
     def parseTTL(self):
         """Returns the representation of the sequence for programming the FPGA"""
-        rep = ''
-        lastChannels = numpy.zeros(self.channelTotal)
-        powerArray = 2**numpy.arange(self.channelTotal, dtype = numpy.uint64)
-        for key,newChannels in sorted(self.switchingTimes.iteritems()):
-            channels = lastChannels + newChannels #computes the action of switching on the state
-            if (channels < 0).any(): raise Exception ('Trying to switch off channel that is not already on')
-            channelInt = numpy.dot(channels,powerArray)
-            rep = rep + self.numToHex(key) + self.numToHex(channelInt) #converts the new state to hex and adds it to the sequence
-            lastChannels = channels
-        rep = rep + 2*self.numToHex(0) #adding termination
-        return rep
+        times, channels = self.switchingTimes.states() #computes the action of switching on the state
+        if (channels < 0).any(): raise Exception ('Trying to switch off channel that is not already on')
+        powerArray = 2**numpy.arange(self.channelTotal, dtype = numpy.int64)
+        channelInts = numpy.dot(channels, powerArray)
+        #every line is the time followed by the channel state, each a 32 bit number split in two 16 bit words as in numToHex
+        words = numpy.zeros((len(times) + 1, 4), dtype = numpy.uint16) #the last line of zeros is the termination
+        words[:-1,0], words[:-1,1] = times // 65536, times % 65536
+        words[:-1,2], words[:-1,3] = channelInts // 65536, channelInts % 65536
+        return words.tostring()
     
     def humanRepresentation(self):
         """Returns the human readable version of the sequence for FPGA for debugging"""
@@ -153,44 +229,135 @@ class Sequence():
     def ddsHumanRepresentation(self, dds):
         program = []
         for name,buf in dds.iteritems():
-            arr = array.array('B', buf)
-            arr = arr[:-2] #remove termination
-            channel = hardwareConfiguration.ddsDict[name]
-            coherent = channel.phase_coherent_model
-            freq_min,freq_max = channel.boardfreqrange
-            ampl_min,ampl_max = channel.boardamplrange
-            def chunks(l, n):
-                """ Yield successive n-sized chunks from l."""
-                for i in xrange(0, len(l), n):
-                    yield l[i:i+n]
-            if not coherent:
-                for a,b,c,d in chunks(arr, 4):
-                    freq_num = (256*b + a)
-                    ampl_num = (256*d + c)
-                    freq = freq_min +  freq_num * (freq_max - freq_min) / float(16**4 - 1)
-                    ampl = ampl_min +  ampl_num * (ampl_max - ampl_min) / float(16**4 - 1)
-                    program.append((name, freq,ampl)) 
-            else:
-                for a,b,c,d,e,f,g,h in chunks(arr, 8):
-                    freq_num = 256**2*(256*h + g) + (256*f + e)
-                    ampl_num = 256*d + c
-                    freq = freq_min +  freq_num * (freq_max - freq_min) / float(16**8 - 1)
-                    ampl = ampl_min +  ampl_num * (ampl_max - ampl_min) / float(16**4 - 1)
-                    program.append((name, freq,ampl)) 
+            freqs, ampls = self.ddsFromBuf(name, buf)
+            program.extend(zip([name] * len(freqs), freqs.tolist(), ampls.tolist()))
         return program
     
-    def ttlHumanRepresentation(self, rep):
+    def ddsFromBuf(self, name, buf):
+        '''decodes the buffer of the dds channel into the arrays of frequencies and amplitudes of its settings'''
+        channel = hardwareConfiguration.ddsDict[name]
+        freq_min,freq_max = channel.boardfreqrange
+        ampl_min,ampl_max = channel.boardamplrange
+        buf = buf[:-2] #remove termination
+        if not channel.phase_coherent_model:
+            words = numpy.frombuffer(buf, dtype = ddsWord)
+            freq_num, ampl_num = words['high'], words['low']
+            freq = freq_min +  freq_num * (freq_max - freq_min) / float(16**4 - 1)
+        else:
+            words = numpy.frombuffer(buf, dtype = ddsCoherentWord)
+            freq_num, ampl_num = words['frequency'], words['amplitude']
+            freq = freq_min +  freq_num * (freq_max - freq_min) / float(16**8 - 1)
+        ampl = ampl_min +  ampl_num * (ampl_max - ampl_min) / float(16**4 - 1)
+        return freq, ampl
+    
+    def ttlFromBuf(self, rep):
+        '''decodes the ttl program into the arrays of the switching times in seconds and of the channel states'''
         arr = numpy.fromstring(rep, dtype = numpy.uint16) #does the decoding from the string
         arr = numpy.array(arr, dtype = numpy.uint32) #once decoded, need to be able to manipulate large numbers
         arr = arr.reshape(-1,4)
         times =( 65536  *  arr[:,0] + arr[:,1]) * float(self.timeResolution)
         channels = ( 65536  *  arr[:,2] + arr[:,3])
+        return times, channels
+    
+    def ttlHumanRepresentation(self, rep):
+        times, channels = self.ttlFromBuf(rep)
+        #the binary representation of each state with the first channel first, i.e 2**31 is 000...01
+        bits = (channels[:, numpy.newaxis] >> numpy.arange(32, dtype = numpy.uint32)) & 1
+        channels = (bits.astype(numpy.uint8) + ord('0')).view('S32').ravel()
+        return numpy.vstack((times,channels)).transpose()
+    
+    def timeline(self, channelNames):
+        '''
+        Returns the Timeline of the compiled sequence, channelNames is a dictionary of the names of the ttl channels for their numbers.
+        Each dds setting lasts from the advance pulse that selects it to the next one, the last one until the reset at the end.
+        '''
+        dds,ttl = self.progRepresentation(parse = False)
+        times, states = self.ttlFromBuf(ttl)
+        times, states = times[:-1], states[:-1] #remove termination
+        timeline = Timeline.fromStates(times, states, channelNames)
+        advances = self._risingEdges(times, states, self.advanceDDS)
+        resets = self._risingEdges(times, states, self.resetDDS)
+        columns = [[], [], [], [], []]
+        for name,buf in sorted((dds or {}).iteritems()):
+            freqs, ampls = self.ddsFromBuf(name, buf)
+            starts = numpy.concatenate(([0.0], advances))[:len(freqs)]
+            end = resets[-1] if len(resets) else times[-1]
+            stops = numpy.concatenate((starts[1:], [end]))
+            for column, values in zip(columns, ([name] * len(freqs), starts, stops, freqs, ampls)):
+                column.extend(values)
+        return Timeline((timeline.ttlChannels, timeline.ttlStarts, timeline.ttlStops), columns)
+    
+    @staticmethod
+    def _risingEdges(times, states, channel):
+        on = ((states >> channel) & 1).astype(numpy.int8)
+        return times[numpy.diff(numpy.concatenate(([0], on))) == 1]
 
-        def expandChannel(ch):
-            '''function for getting the binary representation, i.e 2**32 is 1000...0'''
-            expand = bin(ch)[2:].zfill(32)
-            reverse = expand[::-1]
-            return reverse
-        
-        channels = map(expandChannel,channels)
-        return numpy.vstack((times,channels)).transpose()
\ No newline at end of file
+class SwitchTable(object):
+    """
+    Stores the TTL switches as parallel columns of times, channels and values.
+    The channel states at all of the switching times are computed in a single vectorized pass.
+    """
+    def __init__(self, channelTotal):
+        self.channelTotal = channelTotal
+        self.times = [0]
+        self.channels = [0]
+        self.values = [0]
+        self.distinctTimes = set([0])
+        self.switched = set() #keys of the (time, channel) pairs already holding a switch
+    
+    def __len__(self):
+        return len(self.distinctTimes)
+    
+    def _key(self, timeStep, chan):
+        return timeStep * self.channelTotal + chan
+    
+    def hasTime(self, timeStep):
+        return timeStep in self.distinctTimes
+    
+    def isSwitched(self, timeStep, chan):
+        return self._key(timeStep, chan) in self.switched
+    
+    def lastTime(self):
+        return max(self.distinctTimes)
+    
+    def add(self, timeStep, chan, value):
+        self.times.append(timeStep)
+        self.channels.append(chan)
+        self.values.append(value)
+        self.distinctTimes.add(timeStep)
+        if value: self.switched.add(self._key(timeStep, chan))
+    
+    def timesAfterAdding(self, timeSteps):
+        '''number of distinct switching times there would be after adding the array of times'''
+        return len(self.distinctTimes.union(timeSteps.tolist()))
+    
+    def firstDoubleSwitch(self, timeSteps, chans):
+        '''returns the earliest (time, channel) that would be switched more than once after adding the switches in the arrays, or None'''
+        keys, counts = numpy.unique(self._key(timeSteps, chans), return_counts = True)
+        doubled = self.switched.intersection(keys.tolist())
+        doubled.update(keys[counts > 1].tolist())
+        if not doubled: return None
+        return divmod(min(doubled), self.channelTotal)
+    
+    def extend(self, timeSteps, chans, values):
+        '''adds the arrays of non-zero switches'''
+        self.times.extend(timeSteps.tolist())
+        self.channels.extend(chans.tolist())
+        self.values.extend(values.tolist())
+        self.distinctTimes.update(timeSteps.tolist())
+        self.switched.update(self._key(timeSteps, chans).tolist())
+    
+    def columns(self):
+        '''returns the times, channels and values of all the switches as arrays'''
+        times = numpy.array(self.times, dtype = numpy.int64)
+        channels = numpy.array(self.channels, dtype = numpy.int64)
+        values = numpy.array(self.values, dtype = numpy.int64)
+        return times, channels, values
+    
+    def states(self):
+        '''returns the sorted distinct switching times and the (times x channelTotal) array of channel states after each one'''
+        times, channels, values = self.columns()
+        times, rows = numpy.unique(times, return_inverse = True)
+        changes = numpy.zeros((len(times), self.channelTotal), dtype = numpy.int64)
+        numpy.add.at(changes, (rows, channels), values)
+        return times, numpy.cumsum(changes, axis = 0)
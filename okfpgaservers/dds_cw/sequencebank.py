@@ -0,0 +1,88 @@
+from labrad.server import LabradServer, setting, Signal
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python.failure import Failure
+import time
+
+class SequenceBank(LabradServer):
+
+    """
+    Runs scans over variants of a sequence for the Pulser Server.
+    The variants are compiled up front into the bank of the context, then a single request steps through them:
+    each variant is uploaded, skipping what is already on the board, run for the repetitions and its readout counts are collected.
+    """
+
+    on_bank_variant_done = Signal(611054, 'signal: sequence bank variant done', 'w')
+
+    def initialize(self):
+        self.sequence_bank_running = False
+
+    @setting(80, 'Add To Sequence Bank', returns = 'w')
+    def addToSequenceBank(self, c):
+        """
+        Compiles the current sequence and appends it to the bank of the context, returns the index of the variant.
+        Create a new sequence for the next variant.
+        """
+        sequence = c.get('sequence')
+        if not sequence: raise Exception ("Please create new sequence first")
+        compiled = yield self._compile(sequence)
+        bank = c.setdefault('sequence_bank', [])
+        bank.append(compiled)
+        returnValue(len(bank) - 1)
+
+    @setting(81, 'Clear Sequence Bank', returns = '')
+    def clearSequenceBank(self, c):
+        """Removes all the variants from the bank of the context"""
+        c['sequence_bank'] = []
+
+    @setting(82, 'Run Sequence Bank', repetitions = 'w', timeout = 'v', returns = '*(w*v)')
+    def runSequenceBank(self, c, repetitions, timeout = None):
+        """
+        Runs every variant of the bank in order for the number of repetitions and returns (variant, readout counts) for each.
+        Readout counts left from before the scan are discarded. The signal: sequence bank variant done carries the index
+        of each variant once its counts are read. timeout is the longest time in seconds to wait for a variant to complete.
+        """
+        bank = c.get('sequence_bank')
+        if not bank: raise Exception ("Sequence bank is empty")
+        repetitions = int(repetitions)
+        if not 1 <= repetitions <= (2**16 - 1): raise Exception ("Incorrect number of pulses")
+        if self.sequence_bank_running: raise Exception ("Sequence bank is already running")
+        if timeout is None: timeout = self.sequenceTimeRange[1]
+        self.sequence_bank_running = True
+        results = []
+        try:
+            yield self.fpga.batch((self.api.resetRam,), (self.api.stopLooped,), (self.doGetReadoutCounts,))
+            for index, compiled in enumerate(bank):
+                start = time.time()
+                counts = yield self._runVariant(compiled, repetitions, timeout)
+                self.recordSpan('bank variant', start, 4 * len(counts))
+                results.append((index, counts))
+                self.on_bank_variant_done(index)
+        except Exception:
+            #the variant may still be running, stop the board before anything else can reprogram it
+            failure = Failure()
+            self.unwatchSequence()
+            yield self.fpga.batch((self.api.resetRam,), (self.api.stopLooped,))
+            self.sequenceType = None
+            self.ddsLock = False
+            failure.raiseException()
+        finally:
+            self.sequence_bank_running = False
+        #the board is stopped without Stop Sequence, release the dds like it does
+        self.ddsLock = False
+        returnValue(results)
+
+    @inlineCallbacks
+    def _runVariant(self, compiled, repetitions, timeout):
+        '''uploads and runs one variant, then stops the board and reads the readout counts in the same job'''
+        yield self._uploadProgram(compiled)
+        self.isProgrammed = True
+        yield self.fpga.batch((self.api.setNumberRepeatitions, repetitions), (self.api.resetSeqCounter,), (self.api.startLooped,))
+        self.sequenceType = 'Number'
+        self.watchSequence()
+        done = yield self.sequenceDone(timeout)
+        if not done:
+            self.unwatchSequence()
+            raise Exception ("Sequence bank variant did not complete")
+        counts = yield self.fpga.batch((self.api.resetRam,), (self.api.stopLooped,), (self.doGetReadoutCounts,))
+        self.sequenceType = None
+        returnValue(counts)
@@ -0,0 +1,85 @@
+from labrad.server import LabradServer, Signal
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, Deferred
+from hardwareConfiguration import hardwareConfiguration
+
+class SequenceWatch(LabradServer):
+
+    """Watches the board for the completion of the pulse sequence for the Pulser Server"""
+
+    on_sequence_done = Signal(611052, 'signal: sequence done', 'b')
+
+    def initialize(self):
+        self.sequence_done_waiters = []
+        self.sequence_watch_requested = False #whether a started sequence is being watched
+        self.sequence_watch_running = False
+        self.sequence_poll_range = getattr(hardwareConfiguration, 'sequenceDonePolling', (0.0005, 0.050))
+        self.sequence_poll_interval = self.sequence_poll_range[0]
+        self.sequence_poll_sleep = None #pending wake up of the polling loop
+
+    def watchSequence(self):
+        '''starts watching the board after a sequence of finite length is launched'''
+        self.sequence_watch_requested = True
+        #poll fast again, the loop may still be sleeping at the backed off interval of the previous sequence
+        self.sequence_poll_interval = self.sequence_poll_range[0]
+        if self.sequence_poll_sleep is not None and self.sequence_poll_sleep.active():
+            self.sequence_poll_sleep.reset(self.sequence_poll_interval)
+        self._startSequenceWatch()
+
+    def unwatchSequence(self):
+        '''stops watching the board for a sequence that has been stopped, waiters keep waiting until their timeout'''
+        self.sequence_watch_requested = False
+
+    def sequenceDone(self, timeout):
+        '''returns a deferred that fires with True when the sequence is done or with False after the timeout'''
+        d = Deferred()
+        self.sequence_done_waiters.append(d)
+        timeout_call = reactor.callLater(timeout, self._sequenceWaitTimeout, d)
+        def cancel_timeout(result):
+            if timeout_call.active(): timeout_call.cancel()
+            return result
+        d.addBoth(cancel_timeout)
+        self._startSequenceWatch()
+        return d
+
+    def _sequenceWaitTimeout(self, d):
+        self.sequence_done_waiters.remove(d)
+        d.callback(False)
+
+    def _startSequenceWatch(self):
+        if not self.sequence_watch_running:
+            self.sequence_watch_running = True
+            self._watchSequence()
+
+    @inlineCallbacks
+    def _watchSequence(self):
+        '''
+        polls the board until the sequence is done, while anyone is waiting for it.
+        the polling starts fast and backs off for long sequences.
+        '''
+        fastest, slowest = self.sequence_poll_range
+        self.sequence_poll_interval = fastest
+        try:
+            while self.sequence_watch_requested or self.sequence_done_waiters:
+                done = yield self.fpga.query(self.api.isSeqDone)
+                if done:
+                    self._notifySequenceDone()
+                    break
+                d = Deferred()
+                self.sequence_poll_sleep = reactor.callLater(self.sequence_poll_interval, d.callback, None)
+                yield d
+                self.sequence_poll_interval = min(2 * self.sequence_poll_interval, slowest)
+        except Exception as e:
+            waiters, self.sequence_done_waiters = self.sequence_done_waiters, []
+            for d in waiters:
+                d.errback(e)
+        finally:
+            self.sequence_poll_sleep = None
+            self.sequence_watch_running = False
+
+    def _notifySequenceDone(self):
+        self.sequence_watch_requested = False
+        self.on_sequence_done(True)
+        waiters, self.sequence_done_waiters = self.sequence_done_waiters, []
+        for d in waiters:
+            d.callback(True)
@@ -0,0 +1,262 @@
+'''
+In-process simulation of the pulser board, used in place of the Opal Kelly ok module when
+hardwareConfiguration.simulatedBoard is set or the environment variable SIMULATE_OK_BOARDS=1.
+It provides FrontPanel and PLL22150 with the interface of the ok module and emulates the firmware
+behind the wires, triggers and pipes used by api.py:
+the pulse ram, the ram of each DDS channel, the timing of the sequence and the
+normal, readout and time resolved PMT FIFOs filled with simulated photon counts.
+'''
+import time
+import ctypes
+import threading
+import numpy
+from hardwareConfiguration import hardwareConfiguration
+
+SERIAL = 'SIMULATED'
+FIFO_DEPTH = 2**16 #16-bit words held by each of the PMT FIFOs
+
+class PLL22150(object):
+    DivSrc_VCO = 1
+    def SetDiv1(self, source, divider):
+        self.div1 = (source, divider)
+
+class FrontPanel(object):
+    '''emulates the board running the pulser firmware'''
+    def __init__(self):
+        self.latency = getattr(hardwareConfiguration, 'simulatedLatency', 0.0002)
+        self.brightRate, self.darkRate = getattr(hardwareConfiguration, 'simulatedCountRates', (50000.0, 2000.0))
+        self.brightProbability = getattr(hardwareConfiguration, 'simulatedBrightProbability', 0.5)
+        self.timeResolution = float(hardwareConfiguration.timeResolution)
+        self.timeResolvedResolution = hardwareConfiguration.timeResolvedResolution
+        channels = hardwareConfiguration.channelDict
+        self.readoutChannel = channels['ReadoutCount'].channelnumber
+        self.diffCountChannel = channels['DiffCountTrigger'].channelnumber
+        self.timeResolvedChannel = channels['TimeResolvedCount'].channelnumber
+        self.lock = threading.Lock()
+        self.wireIns = numpy.zeros(32, dtype = numpy.uint32) #pending values, latched by UpdateWireIns
+        self.wires = numpy.zeros(32, dtype = numpy.uint32)
+        self.wireOuts = numpy.zeros(32, dtype = numpy.uint32)
+        self.pulseRam = bytearray(8 * (hardwareConfiguration.maxSwitches + 2))
+        self.pulseRamPosition = 0
+        self.ddsRam = {}
+        self.ddsPosition = 0
+        self.fifos = dict((addr, bytearray()) for addr in [0xa0, 0xa1, 0xa2, 0xa3])
+        self.running = False
+        self.done = False
+        self.completed = 0
+        self.lastCount = time.time()
+        self.opened = False
+
+    def _transfer(self):
+        '''waits for the simulated USB round trip'''
+        if self.latency: time.sleep(self.latency)
+
+    #device enumeration and configuration
+    def GetDeviceCount(self):
+        return 1
+
+    def GetDeviceListSerial(self, i):
+        return SERIAL
+
+    def OpenBySerial(self, serial):
+        self.opened = (serial == SERIAL)
+        return 0 if self.opened else -1
+
+    def GetDeviceID(self):
+        return hardwareConfiguration.okDeviceID if self.opened else ''
+
+    def ConfigureFPGA(self, filename):
+        self._transfer()
+        return 0
+
+    def GetEepromPLL22150Configuration(self, pll):
+        return 0
+
+    def SetPLL22150Configuration(self, pll):
+        return 0
+
+    #wires
+    def SetWireInValue(self, addr, value, mask = 0xffffffff):
+        self.wireIns[addr] = (int(self.wireIns[addr]) & ~mask) | (value & mask)
+        return 0
+
+    def UpdateWireIns(self):
+        self._transfer()
+        with self.lock:
+            now = time.time()
+            self._advance(now)
+            old, new = int(self.wires[0]), int(self.wireIns[0])
+            self.wires[:] = self.wireIns
+            if new & 0x04 and not old & 0x04:
+                self._start(now)
+            elif old & 0x04 and not new & 0x04:
+                self.running = False
+            elif new & 0x04 and old & 0x02 and not new & 0x02:
+                #leaving the looped mode finishes the current repetition
+                self.repetitions = self.started + 1
+        return 0
+
+    def UpdateWireOuts(self):
+        self._transfer()
+        with self.lock:
+            self._advance(time.time())
+            select = int(self.wires[0]) & 0xf0
+            if select == 0x00:
+                self.wireOuts[0x01] = int(self.done)
+            elif select == 0x20:
+                self.wireOuts[0x01] = self.completed & 0xffff
+            elif select == 0x40:
+                self.wireOuts[0x01] = len(self.fifos[0xa1]) // 2
+            elif select == 0x80:
+                self.wireOuts[0x01] = len(self.fifos[0xa2]) // 2
+            elif select == 0xa0:
+                self.wireOuts[0x01] = len(self.fifos[0xa3]) // 2
+            self.wireOuts[0x02] = len(self.fifos[0xa0]) // 2
+        return 0
+
+    def GetWireOutValue(self, addr):
+        return int(self.wireOuts[addr - 0x20])
+
+    #triggers
+    def ActivateTriggerIn(self, addr, bit):
+        self._transfer()
+        with self.lock:
+            self._advance(time.time())
+            if bit == 0:
+                self.completed = 0
+            elif bit == 1:
+                self.pulseRamPosition = 0
+            elif bit in [2, 3]:
+                del self.fifos[{2:0xa1, 3:0xa0}[bit]][:]
+            elif bit == 4:
+                #the readout FIFO and the DDS ram position are reset by the same trigger
+                del self.fifos[0xa2][:]
+                self.ddsPosition = 0
+            elif bit == 5:
+                self.ddsPosition += 1
+            elif bit == 6:
+                self.ddsPosition = 0
+        return 0
+
+    #pipes
+    def WriteToBlockPipeIn(self, addr, blocksize, data):
+        self._transfer()
+        with self.lock:
+            if addr == 0x80:
+                end = self.pulseRamPosition + len(data)
+                if end > len(self.pulseRam): raise Exception("Simulated pulse ram overflow")
+                self.pulseRam[self.pulseRamPosition:end] = data
+                self.pulseRamPosition = end
+            elif addr == 0x81:
+                self.ddsRam[int(self.wires[0x04])] = bytes(data)
+        return len(data)
+
+    def ReadFromBlockPipeOut(self, addr, blocksize, buf):
+        '''fills the given buffer in place like the ok module does'''
+        self._transfer()
+        with self.lock:
+            fifo = self.fifos[addr]
+            data = bytes(fifo[:len(buf)])
+            del fifo[:len(data)]
+        if isinstance(buf, bytearray):
+            buf[:len(data)] = data
+        elif data:
+            ctypes.memmove(ctypes.c_char_p(buf), data, len(data))
+        return len(data)
+
+    #simulation of the running sequence
+    def _program(self):
+        '''returns the switching times in seconds and the ttl states of the programmed sequence'''
+        words = numpy.frombuffer(bytes(self.pulseRam), dtype = '<u2').reshape(-1, 4).astype(numpy.int64)
+        times = 65536 * words[:, 0] + words[:, 1]
+        states = 65536 * words[:, 2] + words[:, 3]
+        ends = numpy.nonzero((times[1:] == 0) & (states[1:] == 0))[0]
+        end = ends[0] + 1 if len(ends) else len(times)
+        return times[:end] * self.timeResolution, states[:end]
+
+    def _gates(self, times, states, channel):
+        '''returns the start and stop times of the pulses of the channel'''
+        on = ((states >> channel) & 1).astype(numpy.int8)
+        edges = numpy.diff(numpy.concatenate(([0], on)))
+        starts = times[edges == 1]
+        stops = times[edges == -1]
+        return starts[:len(stops)], stops
+
+    def _start(self, now):
+        times, states = self._program()
+        self.duration = max(times[-1], self.timeResolution)
+        self.readoutGates = self._gates(times, states, self.readoutChannel)
+        self.diffGates = self._gates(times, states, self.diffCountChannel)
+        self.timeResolvedGates = self._gates(times, states, self.timeResolvedChannel)
+        looped = bool(int(self.wires[0]) & 0x02)
+        #a looped sequence with no set number of repetitions runs until stopped
+        self.repetitions = (int(self.wires[0x05]) or None) if looped else 1
+        self.running = True
+        self.done = False
+        self.startTime = now
+        self.started = 0 #repetitions simulated since the start
+        self.ddsPosition = 0
+
+    def _advance(self, now):
+        '''generates the counts up to the current time'''
+        if int(self.wires[0]) & 0x01:
+            self.lastCount = now
+        else:
+            self._normalCounts(now)
+        if not self.running or self.done: return
+        total = int((now - self.startTime) / self.duration)
+        if self.repetitions is not None and total >= self.repetitions:
+            total = self.repetitions
+            self.done = True
+        new = total - self.started
+        if new <= 0: return
+        self.started = total
+        self.completed += new
+        self._sequenceCounts(new)
+
+    def _photons(self, durations, size):
+        '''returns simulated photon counts for the gate durations, the ion being bright or dark in each repetition'''
+        bright = numpy.random.random_sample((size, 1)) < self.brightProbability
+        rates = numpy.where(bright, self.brightRate, self.darkRate)
+        return numpy.random.poisson(rates * durations)
+
+    def _normalCounts(self, now):
+        period = int(self.wires[0x01]) / 1000.0
+        if period <= 0: return
+        number = int((now - self.lastCount) / period)
+        if not number: return
+        self.lastCount += number * period
+        number = min(number, FIFO_DEPTH // 2)
+        self._push(0xa1, numpy.random.poisson(self.brightRate * period, number))
+        if hardwareConfiguration.secondPMT:
+            self._push(0xa3, numpy.random.poisson(self.brightRate * period, number))
+
+    def _sequenceCounts(self, repetitions):
+        repetitions = min(repetitions, FIFO_DEPTH)
+        starts, stops = self.readoutGates
+        if len(starts):
+            self._push(0xa2, self._photons(stops - starts, repetitions).ravel())
+        #in the differential mode, the counts alternate between 866 on and off
+        starts, stops = self.diffGates
+        if len(starts) and int(self.wires[0]) & 0x01:
+            counts = numpy.random.poisson(numpy.array([self.brightRate, self.darkRate]) * (stops - starts).sum(), (repetitions, 2))
+            counts[:, 1] |= 2**31
+            self._push(0xa1, counts.ravel())
+        starts, stops = self.timeResolvedGates
+        if len(starts):
+            numbers = self._photons(stops - starts, repetitions).ravel()
+            gate = numpy.repeat(numpy.tile(numpy.arange(len(starts)), repetitions), numbers)
+            repetition = numpy.repeat(numpy.arange(repetitions).repeat(len(starts)), numbers)
+            ticks = starts[gate] + numpy.random.random_sample(len(gate)) * (stops - starts)[gate]
+            ticks = ticks[numpy.lexsort((ticks, repetition))]
+            self._push(0xa0, (ticks / self.timeResolvedResolution).astype(numpy.int64))
+
+    def _push(self, addr, values):
+        '''adds 32-bit values to the FIFO as the most significant then the least significant 16-bit word'''
+        values = numpy.asarray(values, dtype = numpy.int64)
+        words = numpy.empty((len(values), 2), dtype = '<u2')
+        words[:, 0] = (values >> 16) & 0xffff
+        words[:, 1] = values & 0xffff
+        fifo = self.fifos[addr]
+        space = 2 * FIFO_DEPTH - len(fifo)
+        fifo.extend(words.tostring()[:max(space, 0) // 4 * 4])
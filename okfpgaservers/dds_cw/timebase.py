@@ -0,0 +1,70 @@
+import numpy
+from fractions import Fraction
+from decimal import Decimal
+
+class TimeBase(object):
+    """
+    Converts times in seconds to FPGA time steps.
+    Times are first rounded to nanoseconds and then to the nearest time step, both with round half to even.
+    All the rounding is done with exact integer arithmetic so the result is always the same as
+    formatting the time to nanoseconds and dividing as decimals.
+    """
+    NS_PER_SEC = 10**9
+    #the float product time * 1e9 is only trusted to be rounded correctly when it is further than this from a half nanosecond
+    TIE_TOLERANCE = 1e-3
+
+    def __init__(self, timeResolution):
+        '''timeResolution is the string or number of seconds in one time step, i.e '40.0e-9' '''
+        resolution = Fraction(Decimal(str(timeResolution))) * self.NS_PER_SEC #nanoseconds per step
+        self.resolutionNum = resolution.numerator
+        self.resolutionDen = resolution.denominator
+
+    @staticmethod
+    def _roundHalfEven(num, den):
+        '''rounds num / den to the nearest integer, ties to even. works on integers and integer arrays'''
+        quotient, remainder = num // den, num % den
+        twice = 2 * remainder
+        return quotient + ((twice > den) | ((twice == den) & (quotient % 2 == 1)))
+
+    def secToNs(self, sec):
+        '''converts seconds to the nearest integer number of nanoseconds'''
+        num, den = float(sec).as_integer_ratio()
+        return int(self._roundHalfEven(num * self.NS_PER_SEC, den))
+
+    def secToStep(self, sec):
+        '''converts seconds to time steps'''
+        ns = self.secToNs(sec)
+        return int(self._roundHalfEven(ns * self.resolutionDen, self.resolutionNum))
+
+    def secToSteps(self, secs):
+        '''converts an array of times in seconds to an array of time steps'''
+        secs = numpy.asarray(secs, dtype = numpy.float64)
+        scaled = secs * self.NS_PER_SEC
+        ns = numpy.rint(scaled).astype(numpy.int64)
+        #the product can be off by a rounding error, so times close to half a nanosecond are redone exactly
+        close = numpy.abs(scaled - numpy.floor(scaled) - 0.5) < self.TIE_TOLERANCE
+        if close.any():
+            ns[close] = [self.secToNs(sec) for sec in secs[close]]
+        return self._roundHalfEven(ns * self.resolutionDen, self.resolutionNum).astype(numpy.int64)
+
+if __name__ == '__main__':
+    #checks the conversion against the decimal implementation over the full range of sequence times
+    import random
+    from hardwareConfiguration import hardwareConfiguration
+    def decimalSecToStep(sec):
+        start = Decimal('{0:.9f}'.format(sec))
+        return int((start / Decimal(hardwareConfiguration.timeResolution)).to_integral_value())
+    timeBase = TimeBase(hardwareConfiguration.timeResolution)
+    low, high = hardwareConfiguration.sequenceTimeRange
+    resolution = float(hardwareConfiguration.timeResolution)
+    times = [random.uniform(low, high) for i in range(20000)]
+    times += [random.uniform(low, min(high, 1e-3)) for i in range(20000)]
+    #multiples and half multiples of the resolution and of a nanosecond, as well as exactly representable half nanoseconds
+    times += [n * resolution / 2.0 for n in random.sample(xrange(int(2 * high / resolution)), 20000)]
+    times += [(n + 0.5) * 1e-9 for n in random.sample(xrange(int(high * 1e9)), 20000)]
+    times += [n / 1024.0 for n in xrange(int(high * 1024))]
+    times = [t for t in times if low <= t <= high] + [low, high]
+    expected = [decimalSecToStep(t) for t in times]
+    assert [timeBase.secToStep(t) for t in times] == expected
+    assert timeBase.secToSteps(times).tolist() == expected
+    print 'Checked {} times'.format(len(times))
@@ -0,0 +1,76 @@
+import numpy
+
+class Timeline(object):
+    """
+    Columnar form of a compiled pulse sequence, used for inspecting and plotting sequences of any length.
+    The ttl part holds one row per pulse of each channel: the channel name, the start and the stop in seconds.
+    The dds part holds one row per segment of constant setting of each channel:
+    the channel name, the start and the stop in seconds, the frequency in MHz and the amplitude in dBm.
+    The rows are sorted by channel and then by time.
+    """
+    ttlColumns = ['ttlChannels', 'ttlStarts', 'ttlStops']
+    ddsColumns = ['ddsChannels', 'ddsStarts', 'ddsStops', 'ddsFrequencies', 'ddsAmplitudes']
+
+    def __init__(self, ttl, dds):
+        '''ttl is (channels, starts, stops) and dds is (channels, starts, stops, frequencies, amplitudes)'''
+        for name, column in zip(self.ttlColumns + self.ddsColumns, list(ttl) + list(dds)):
+            dtype = str if name.endswith('Channels') else numpy.float64
+            setattr(self, name, numpy.asarray(column, dtype = dtype))
+
+    @classmethod
+    def fromStates(cls, times, states, channelNames, dds = None):
+        '''
+        builds the timeline from the switching times and the 32 bit states of the ttl channels at these times
+        channelNames is a dictionary of the channel names for the hardware channel numbers
+        '''
+        times = numpy.asarray(times, dtype = numpy.float64)
+        bits = (numpy.asarray(states, dtype = numpy.int64)[:, numpy.newaxis] >> numpy.arange(32)) & 1
+        #the channels are off before the sequence starts
+        edges = numpy.diff(numpy.vstack((numpy.zeros((1, 32), dtype = numpy.int64), bits)), axis = 0)
+        rising_channels, rising_rows = numpy.nonzero(edges.transpose() == 1)
+        falling_channels, falling_rows = numpy.nonzero(edges.transpose() == -1)
+        #channels still on at the end of the sequence stay on until the last time
+        still_on = numpy.nonzero(bits[-1])[0] if len(bits) else numpy.zeros(0, dtype = numpy.int64)
+        stops = numpy.concatenate((times[falling_rows], numpy.repeat(times[-1:], len(still_on))))
+        stop_channels = numpy.concatenate((falling_channels, still_on))
+        stops = stops[numpy.lexsort((stops, stop_channels))]
+        names = numpy.array([channelNames.get(channel, str(channel)) for channel in range(32)], dtype = str)
+        ttl = (names[rising_channels], times[rising_rows], stops)
+        if dds is None: dds = ([], [], [], [], [])
+        return cls(ttl, dds)
+
+    @classmethod
+    def fromPulser(cls, pulser):
+        '''gets the timeline of the programmed sequence from the pulser server'''
+        ttl = pulser.timeline_ttl()
+        dds = pulser.timeline_dds()
+        return cls(ttl, dds)
+
+    @classmethod
+    def load(cls, filename):
+        '''loads the timeline saved with save'''
+        data = numpy.load(filename)
+        return cls([data[name] for name in cls.ttlColumns], [data[name] for name in cls.ddsColumns])
+
+    def save(self, filename):
+        '''saves the timeline into a numpy .npz file'''
+        numpy.savez(filename, **dict((name, getattr(self, name)) for name in self.ttlColumns + self.ddsColumns))
+
+    def saveCSV(self, filename):
+        '''saves the timeline as a table of ttl pulses followed by the dds segments'''
+        with open(filename, 'w') as f:
+            f.write('type,channel,start,stop,frequency,amplitude\n')
+            for row in zip(self.ttlChannels, self.ttlStarts, self.ttlStops):
+                f.write('TTL,{0},{1!r},{2!r},,\n'.format(*row))
+            for row in zip(self.ddsChannels, self.ddsStarts, self.ddsStops, self.ddsFrequencies, self.ddsAmplitudes):
+                f.write('DDS,{0},{1!r},{2!r},{3!r},{4!r}\n'.format(*row))
+
+    def ttlChannel(self, name):
+        '''returns the starts and stops of the pulses of the channel'''
+        selected = self.ttlChannels == name
+        return self.ttlStarts[selected], self.ttlStops[selected]
+
+    def ddsChannel(self, name):
+        '''returns the starts, stops, frequencies and amplitudes of the segments of the channel'''
+        selected = self.ddsChannels == name
+        return self.ddsStarts[selected], self.ddsStops[selected], self.ddsFrequencies[selected], self.ddsAmplitudes[selected]
@@ -0,0 +1,104 @@
+from labrad.server import LabradServer, setting, Signal
+from twisted.internet.defer import inlineCallbacks
+from twisted.python import log
+from hardwareConfiguration import hardwareConfiguration
+import numpy
+
+class TimetagRing(object):
+    """
+    Fixed size ring buffer of the raw timetags.
+    Positions count all the timetags ever written, so readers can tell how many were overwritten before they read them.
+    """
+    def __init__(self, size):
+        self.data = numpy.zeros(size, dtype = numpy.uint32)
+        self.written = 0
+
+    def write(self, values):
+        size = len(self.data)
+        total = len(values)
+        values = values[-size:]
+        start = (self.written + total - len(values)) % size
+        first = min(len(values), size - start)
+        self.data[start:start + first] = values[:first]
+        self.data[:len(values) - first] = values[first:]
+        self.written += total
+
+    def read(self, position):
+        '''returns the number of timetags lost since the position, and a copy of the timetags that are still available'''
+        size = len(self.data)
+        oldest = max(self.written - size, 0)
+        lost = max(oldest - position, 0)
+        start = max(position, oldest)
+        indices = numpy.arange(start, self.written) % size
+        return lost, self.data[indices]
+
+class TimetagStream(LabradServer):
+
+    """Streams the timetags from the time resolved FIFO for the Pulser Server"""
+
+    on_new_timetags = Signal(611053, 'signal: new timetags', 'w')
+
+    def initialize(self):
+        self.timetag_streaming = False
+        self.timetag_draining = False
+        self.timetag_chunk = getattr(hardwareConfiguration, 'timetagChunk', 2**15) // 2 * 2 #whole timetags of two words
+        self.timetag_polling = getattr(hardwareConfiguration, 'timetagPolling', 0.010)
+        self.timetag_ring = TimetagRing(getattr(hardwareConfiguration, 'timetagBufferSize', 2**22))
+
+    @setting(34, 'Start Timetag Stream', returns = '')
+    def startTimetagStream(self, c):
+        """
+        Starts draining the time resolved FIFO in the background into a buffer on the server.
+        Clients then pull the new timetags with Get Streamed Timetags, optionally notified through the new timetags signal
+        that carries the total number of timetags recorded since the start of the stream.
+        """
+        if self.timetag_streaming: return
+        self.timetag_ring = TimetagRing(len(self.timetag_ring.data))
+        self.timetag_streaming = True
+        if not self.timetag_draining:
+            self.timetag_draining = True
+            self._drainTimetags()
+
+    @setting(35, 'Stop Timetag Stream', returns = '')
+    def stopTimetagStream(self, c):
+        """Stops draining the time resolved FIFO, the recorded timetags can still be pulled"""
+        self.timetag_streaming = False
+
+    @setting(37, 'Get Streamed Timetags', returns = '(w*v)')
+    def getStreamedTimetags(self, c):
+        """
+        Returns the timetags recorded since the last call in this context as (lost, timetags).
+        lost is the number of timetags that were overwritten in the buffer before being pulled.
+        """
+        ring, position = c.get('timetag_stream', (None, 0))
+        if ring is not self.timetag_ring: position = 0
+        lost, ticks = self.timetag_ring.read(position)
+        c['timetag_stream'] = (self.timetag_ring, self.timetag_ring.written)
+        return (lost, ticks * self.timeResolvedResolution)
+
+    def doReadTimetagChunk(self):
+        counted = self.api.getResolvedTotal()
+        words = min(counted // 2 * 2, self.timetag_chunk)
+        return self.api.getResolvedCounts(words)
+
+    @inlineCallbacks
+    def _drainTimetags(self):
+        '''
+        reads the FIFO one chunk at a time, so that every chunk is a separate job for the board.
+        keeps reading while the chunks are full and waits between checks once the FIFO is empty.
+        '''
+        try:
+            while self.timetag_streaming:
+                raw = yield self.fpga.run(self.doReadTimetagChunk)
+                ticks = self.countsFromBuf(raw)
+                if len(ticks):
+                    self.timetag_ring.write(ticks)
+                    self.on_new_timetags(self.timetag_ring.written)
+                if len(raw) < 2 * self.timetag_chunk:
+                    yield self.wait(self.timetag_polling)
+        except Exception:
+            #stop the stream so that it can be started again
+            self.timetag_streaming = False
+            log.err(None, 'Timetag stream stopped')
+        finally:
+            self.timetag_draining = False
@@ -0,0 +1,104 @@
+from labrad.server import LabradServer, setting
+from hardwareConfiguration import hardwareConfiguration
+from collections import OrderedDict, deque
+import time
+import numpy
+
+class SpanHistory(object):
+    """
+    Durations and transferred bytes of the most recent occurrences of one timed step, kept in a fixed size ring.
+    """
+    def __init__(self, size):
+        self.durations = numpy.zeros(size)
+        self.transferred = numpy.zeros(size, dtype = numpy.int64)
+        self.count = 0
+
+    def add(self, duration, transferred):
+        position = self.count % len(self.durations)
+        self.durations[position] = duration
+        self.transferred[position] = transferred
+        self.count += 1
+
+    def recent(self):
+        '''returns the durations and the transferred bytes that are kept, not in order'''
+        kept = min(self.count, len(self.durations))
+        return self.durations[:kept], self.transferred[:kept]
+
+class TimingProfile(LabradServer):
+
+    """Records how long the steps of programming, running and reading out the sequences take for the Pulser Server"""
+
+    def initialize(self):
+        self.timing_history = getattr(hardwareConfiguration, 'timingHistory', 1000)
+        self.timing_edges = numpy.logspace(*getattr(hardwareConfiguration, 'timingHistogramRange', (-6, 2, 33)))
+        self.timing_spans = OrderedDict()
+        self.timing_tracing = False
+        self.timing_traces = deque(maxlen = getattr(hardwareConfiguration, 'timingTraces', 100))
+
+    def recordSpan(self, name, start, transferred = 0):
+        '''records the step that started at the time.time() start and ends now'''
+        stop = time.time()
+        history = self.timing_spans.get(name)
+        if history is None:
+            history = self.timing_spans[name] = SpanHistory(self.timing_history)
+        history.add(stop - start, transferred)
+        if self.timing_tracing and self.timing_traces:
+            origin, spans = self.timing_traces[-1]
+            spans.append((name, start - origin, stop - start, transferred))
+
+    def traceSequence(self):
+        '''starts the trace of a new sequence, the following steps are recorded into it until the next sequence'''
+        if self.timing_tracing:
+            self.timing_traces.append((time.time(), []))
+
+    @setting(70, 'Get Timing Statistics', returns = '*(swvvvvv)')
+    def getTimingStatistics(self, c):
+        """
+        Returns the statistics of the recently timed steps as (step, occurrences, mean, median, 90th percentile, maximum, mean bytes)
+        where occurrences counts all the times the step was timed and the durations are in seconds.
+        """
+        statistics = []
+        for name,history in self.timing_spans.iteritems():
+            durations, transferred = history.recent()
+            median, percentile = numpy.percentile(durations, [50, 90])
+            statistics.append((name, history.count, durations.mean(), median, percentile, durations.max(), transferred.mean()))
+        return statistics
+
+    @setting(71, 'Get Timing Histogram', name = 's', returns = '(*v*w)')
+    def getTimingHistogram(self, c, name):
+        """
+        Returns the histogram of the recent durations of the step as the bin edges in seconds and the counts in each bin.
+        Durations outside of the edges are counted in the first or the last bin.
+        """
+        history = self.timing_spans.get(name)
+        if history is None: raise Exception("No timing recorded for {}".format(name))
+        durations, transferred = history.recent()
+        edges = self.timing_edges
+        counts, edges = numpy.histogram(numpy.clip(durations, edges[0], edges[-1]), bins = edges)
+        return (edges, counts)
+
+    @setting(72, 'Reset Timing Statistics', returns = '')
+    def resetTimingStatistics(self, c):
+        """Forgets all the timed steps and the traces"""
+        self.timing_spans = OrderedDict()
+        self.timing_traces.clear()
+
+    @setting(73, 'Timing Trace', enable = 'b', returns = 'b')
+    def timingTrace(self, c, enable = None):
+        """
+        Enables or disables tracing, returns whether it is enabled.
+        When tracing, the steps following the programming of every sequence are recorded for that sequence.
+        """
+        if enable is not None:
+            self.timing_tracing = enable
+        return self.timing_tracing
+
+    @setting(74, 'Get Timing Trace', index = 'w', returns = '*(svvw)')
+    def getTimingTrace(self, c, index = 0):
+        """
+        Returns the trace of a programmed sequence as the steps (step, start, duration, bytes) in order, with the times in seconds
+        since the sequence started being programmed. index 0 is the latest sequence, 1 the one before and so on.
+        """
+        if index >= len(self.timing_traces): raise Exception("No such timing trace")
+        origin, spans = self.timing_traces[-1 - index]
+        return spans
@@ -0,0 +1,101 @@
+import numpy
+
+class SequenceValidator(object):
+    """
+    Checks a sequence before it is compiled and reports all of its problems at once.
+    The pulses of each channel are sorted by their start, and a pulse overlaps the earlier ones when it starts before
+    the latest of their stops, so all the overlaps are found in a single sort and sweep.
+    Each problem is (kind, channel, start, stop, message) with the times in seconds, the kinds are
+    'overlap', 'resolution', 'spacing', 'range' and 'unmatched'.
+    """
+    def __init__(self, sequence, channelNames):
+        self.sequence = sequence
+        self.channelNames = channelNames
+        self.resolution = float(sequence.timeResolution)
+
+    def problems(self):
+        '''returns the list of problems sorted by time'''
+        problems = self.ttlProblems() + self.ddsProblems()
+        return sorted(problems, key = lambda problem: (problem[2], problem[1]))
+
+    def ttlProblems(self):
+        times, channels, values = self.sequence.switchingTimes.columns()
+        names = lambda chans: [self.channelNames.get(chan, str(chan)) for chan in chans]
+        channels, starts, stops, unmatched = self.pulses(channels[values > 0], times[values > 0], channels[values < 0], times[values < 0])
+        problems = [('unmatched', name, 0.0, 0.0, 'Unmatched switches for channel {}'.format(name)) for name in names(unmatched)]
+        index, until = self.overlaps(channels, starts, stops)
+        for name, start, stop in zip(names(channels[index]), starts[index], until):
+            problems.append(self.problem('overlap', name, start, stop, 'Found overlap of two pulses for channel {0} from {1} to {2} s'))
+        return problems
+
+    def ddsProblems(self):
+        entries = self.sequence.ddsSettingList
+        if not entries: return []
+        names, steps, nums, typs = zip(*entries)
+        names, steps, starting = numpy.array(names), numpy.array(steps, dtype = numpy.int64), numpy.array(typs) == 'start'
+        channels, starts, stops, unmatched = self.pulses(names[starting], steps[starting], names[~starting], steps[~starting])
+        problems = [('unmatched', name, 0.0, 0.0, 'Unmatched dds start and stop for channel {}'.format(name)) for name in unmatched]
+        index, until = self.overlaps(channels, starts, stops)
+        for name, start, stop in zip(channels[index], starts[index], until):
+            problems.append(self.problem('overlap', name, start, stop, 'Found overlap of two dds pulses for channel {0} from {1} to {2} s'))
+        short = numpy.nonzero(stops <= starts)[0]
+        for name, start, stop in zip(channels[short], starts[short], stops[short]):
+            problems.append(self.problem('resolution', name, start, stop, 'DDS pulse for channel {0} at {1} s is shorter than the time resolution'))
+        #every change of the dds is triggered by an advance pulse lasting the reset step, which have to be separated
+        changes = numpy.unique(steps)
+        close = numpy.nonzero(numpy.diff(changes) <= self.sequence.resetstepDuration)[0]
+        for start, stop in zip(changes[close], changes[close + 1]):
+            problems.append(self.problem('spacing', 'AdvanceDDS', start, stop, 'DDS settings at {1} and {2} s are closer than the reset step'))
+        problems.extend(self.switchProblems(changes))
+        return problems
+
+    def switchProblems(self, changes):
+        '''checks that the switches added by the compilation for advancing and resetting the dds fit in the pulse ram'''
+        sequence = self.sequence
+        resetStep = sequence.resetstepDuration
+        advances = changes[changes > 0]
+        times = sequence.switchingTimes.distinctTimes.union(advances.tolist(), (advances + resetStep).tolist())
+        lastTime = max(times)
+        switches = len(times.union([lastTime + resetStep]))
+        if switches <= sequence.MAX_SWITCHES: return []
+        return [self.problem('range', 'ResetDDS', 0, lastTime + resetStep, 'Exceeded maximum number of switches {4}', switches)]
+
+    def problem(self, kind, channel, start, stop, message, *args):
+        start, stop = start * self.resolution, stop * self.resolution
+        return (kind, channel, start, stop, message.format(channel, start, stop, kind, *args))
+
+    @staticmethod
+    def pulses(startChannels, starts, stopChannels, stops):
+        '''
+        pairs the starts and stops of each channel in time order, returns the channels, starts and stops of the pulses
+        sorted by channel and start, and the channels whose numbers of starts and stops differ which are left out
+        '''
+        startNames, startCounts = numpy.unique(startChannels, return_counts = True)
+        stopNames, stopCounts = numpy.unique(stopChannels, return_counts = True)
+        counts = dict(zip(startNames.tolist(), startCounts.tolist()))
+        unmatched = set(startNames.tolist()).symmetric_difference(stopNames.tolist())
+        unmatched.update(name for name, count in zip(stopNames.tolist(), stopCounts.tolist()) if counts.get(name, count) != count)
+        unmatched = sorted(unmatched)
+        keepStarts = ~numpy.in1d(startChannels, unmatched)
+        keepStops = ~numpy.in1d(stopChannels, unmatched)
+        startChannels, starts = startChannels[keepStarts], starts[keepStarts]
+        stopChannels, stops = stopChannels[keepStops], stops[keepStops]
+        startOrder = numpy.lexsort((starts, startChannels))
+        stopOrder = numpy.lexsort((stops, stopChannels))
+        return startChannels[startOrder], starts[startOrder], stops[stopOrder], unmatched
+
+    @staticmethod
+    def overlaps(channels, starts, stops):
+        '''
+        returns the indices of the pulses starting before an earlier pulse of the same channel stops, and the time until which they overlap.
+        the pulses have to be sorted by channel and start.
+        '''
+        if not len(starts): return numpy.zeros(0, dtype = numpy.int64), numpy.zeros(0, dtype = numpy.int64)
+        #the running maximum of the stops, restarted for each channel by offsetting the channels from each other
+        names, group = numpy.unique(channels, return_inverse = True)
+        offset = group * (stops.max() + 1)
+        latest = numpy.maximum.accumulate(stops + offset) - offset
+        sameChannel = numpy.concatenate(([False], channels[1:] == channels[:-1]))
+        previous = numpy.concatenate(([0], latest[:-1]))
+        index = numpy.nonzero(sameChannel & (starts < previous))[0]
+        return index, numpy.minimum(previous[index], stops[index])
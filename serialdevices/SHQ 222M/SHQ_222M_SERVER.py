@@ -17,15 +17,17 @@ timeout = 20
 """
 #written by Michael Ramm, Haeffner lab, Nov 2011
 from common.serialdevices.serialdeviceserver import SerialDeviceServer, setting, inlineCallbacks, SerialDeviceError, SerialConnectionError, PortRegError
-from twisted.internet.defer import returnValue, Deferred
+from twisted.internet.defer import returnValue, Deferred, DeferredLock
 from twisted.internet import reactor
 from labrad.units import WithUnit
 from labrad.server import Signal
+from lattice.abstractdevices.voltageramp import VoltageRamp
 
 CHANNELS = 2
 VOLTAGE_MIN = WithUnit(0, 'V')
 VOLTAGE_MAX = WithUnit(2000, 'V')
 RAMP = 20 #Volts / sec
+RAMP_RATE = 5 #default setpoint updates per second when ramping on the server
 
 class SHQ_222M( SerialDeviceServer ):
     """
@@ -38,6 +40,7 @@ class SHQ_222M( SerialDeviceServer ):
     timeout = WithUnit(1.0, 's')
     
     onNewVoltage = Signal(564867, 'signal: new voltage', '(wv)')
+    onRampProgress = Signal(564868, 'signal: ramp progress', '(v*(wv))')
 
     @inlineCallbacks
     def initServer( self ):
@@ -58,6 +61,9 @@ class SHQ_222M( SerialDeviceServer ):
                 print 'Check set up and restart serial server'
             else: raise
         self.listeners = set()
+        self.inCommunication = DeferredLock() #every exchange of writes and replies with the device holds the lock
+        self.setpoints = {} #last setpoints written during a ramp
+        self.ramp = VoltageRamp(self.write_voltages, RAMP_RATE, self.ramp_progress)
         yield self.initDevice()
     
     @inlineCallbacks
@@ -72,9 +78,13 @@ class SHQ_222M( SerialDeviceServer ):
         '''
         for channel in range(1, CHANNELS + 1):
             set_str, expected_response = self._auto_start_str(channel)
-            yield self.ser.write(set_str)
-            resp_0 = yield self.ser.readline()
-            resp_1 = yield self.ser.readline()
+            yield self.inCommunication.acquire()
+            try:
+                yield self.ser.write(set_str)
+                resp_0 = yield self.ser.readline()
+                resp_1 = yield self.ser.readline()
+            finally:
+                self.inCommunication.release()
             assert (resp_0,resp_1) == expected_response, "Incorrect Response"
     
     @inlineCallbacks
@@ -84,9 +94,13 @@ class SHQ_222M( SerialDeviceServer ):
         '''
         for channel in range(1, CHANNELS + 1):
             set_str, expected_response = self._set_ramp_speed_str(channel, RAMP)
-            yield self.ser.write(set_str)
-            resp_0 = yield self.ser.readline()
-            resp_1 = yield self.ser.readline()
+            yield self.inCommunication.acquire()
+            try:
+                yield self.ser.write(set_str)
+                resp_0 = yield self.ser.readline()
+                resp_1 = yield self.ser.readline()
+            finally:
+                self.inCommunication.release()
             assert (resp_0,resp_1) == expected_response, "Incorrect Response"
     
     @setting( 0 , channel = 'w: channel', voltage = 'v[V]: voltage', returns = 'v[V]: voltage')
@@ -100,17 +114,25 @@ class SHQ_222M( SerialDeviceServer ):
             if not (VOLTAGE_MIN <= voltage and voltage <= VOLTAGE_MAX):
                 raise Exception ("Voltage out of range")
             send, expected_response = self._set_voltage_str(channel, voltage['V'])
-            yield self.ser.write(send)
-            resp_0 = yield self.ser.readline()
-            resp_1 = yield self.ser.readline()
+            yield self.inCommunication.acquire()
+            try:
+                yield self.ser.write(send)
+                resp_0 = yield self.ser.readline()
+                resp_1 = yield self.ser.readline()
+            finally:
+                self.inCommunication.release()
             assert (resp_0,resp_1) == expected_response, "Incorrect Response"   
             self.notifyOtherListeners(c, (channel, voltage), self.onNewVoltage)    
         else:
             #reading voltage
             send, expected_response = self._get_voltage_str(channel)
-            yield self.ser.write(send)
-            resp_0 = yield self.ser.readline()
-            voltage = yield self.ser.readline()
+            yield self.inCommunication.acquire()
+            try:
+                yield self.ser.write(send)
+                resp_0 = yield self.ser.readline()
+                voltage = yield self.ser.readline()
+            finally:
+                self.inCommunication.release()
             assert resp_0 == expected_response, "Incorrect Response"
             mantisee,exponent = int(voltage[:5]),int(voltage[5:])
             voltage = WithUnit(mantisee * 10**exponent, 'V')
@@ -128,9 +150,13 @@ class SHQ_222M( SerialDeviceServer ):
         if not channel in range(1, CHANNELS + 1):
             raise Exception ("Incorrect channel")
         send, expected_response = self._get_actual_voltage_str(channel)
-        yield self.ser.write(send)
-        resp_0 = yield self.ser.readline()
-        voltage = yield self.ser.readline()
+        yield self.inCommunication.acquire()
+        try:
+            yield self.ser.write(send)
+            resp_0 = yield self.ser.readline()
+            voltage = yield self.ser.readline()
+        finally:
+            self.inCommunication.release()
         mantisee,exponent = int(voltage[:6]),int(voltage[6:])
         voltage = WithUnit(mantisee * 10**exponent, 'V')
         returnValue(voltage)
@@ -158,6 +184,71 @@ class SHQ_222M( SerialDeviceServer ):
                 returnValue(True)
         returnValue(False)
         
+    @setting(4, voltages = '*(wv[V])', duration = 'v[s]', profile = 's', rate = 'v[Hz]', returns = 'b')
+    def ramp_voltages(self, c, voltages, duration, profile = 'linear', rate = None):
+        '''
+        ramp the setpoints of the channels together to the given (channel, voltage) targets over the duration.
+        the profile is either 'linear' or 'scurve' which starts and stops smoothly. the setpoints are updated at the given
+        rate, RAMP_RATE by default. the device follows the setpoints at its own ramp speed, so the ramp can not be faster
+        than it. the progress is announced with the 'signal: ramp progress'.
+        returns True once the setpoints reach the targets or False if the ramp was cancelled.
+        '''
+        if not len(voltages): returnValue(True)
+        channels = [channel for channel,voltage in voltages]
+        if len(set(channels)) != len(channels): raise Exception ("Channels can only be set once")
+        for channel,voltage in voltages:
+            if not channel in range(1, CHANNELS + 1):
+                raise Exception ("Incorrect channel")
+            if not (VOLTAGE_MIN <= voltage and voltage <= VOLTAGE_MAX):
+                raise Exception ("Voltage out of range")
+        self.ramp.checkProfile(profile)
+        if rate is not None: rate = rate['Hz']
+        self.ramp.checkRate(rate)
+        starts = []
+        for channel in channels:
+            start = yield self.voltage(c, channel)
+            starts.append(start['V'])
+        targets = [voltage['V'] for channel,voltage in voltages]
+        largest_step = max(abs(target - start) for start,target in zip(starts, targets))
+        if largest_step * VoltageRamp.peakSpeed[profile] > RAMP * duration['s']:
+            raise Exception ("Ramp is faster than the ramp speed of the device")
+        completed = yield self.ramp.ramp(channels, starts, targets, duration['s'], profile, rate)
+        for channel in channels:
+            self.notifyOtherListeners(c, (channel, WithUnit(self.setpoints[channel], 'V')), self.onNewVoltage)
+        returnValue(completed)
+    
+    @setting(5, returns = '')
+    def cancel_ramp(self, c):
+        '''
+        stop the ramp in progress at the setpoints reached so far
+        '''
+        self.ramp.cancel()
+    
+    @inlineCallbacks
+    def write_voltages(self, channels, voltages):
+        '''
+        sends the setpoints of all the channels, then reads all of the confirmations
+        '''
+        expected = []
+        responses = []
+        yield self.inCommunication.acquire()
+        try:
+            for channel,voltage in zip(channels, voltages):
+                send, expected_response = self._set_voltage_str(channel, voltage)
+                yield self.ser.write(send)
+                expected.append(expected_response)
+            for expected_response in expected:
+                resp_0 = yield self.ser.readline()
+                resp_1 = yield self.ser.readline()
+                responses.append((resp_0,resp_1))
+        finally:
+            self.inCommunication.release()
+        assert responses == expected, "Incorrect Response"
+        self.setpoints.update(zip(channels, voltages))
+    
+    def ramp_progress(self, fraction, channels, voltages):
+        self.onRampProgress((fraction, zip(channels, voltages.tolist())))
+    
     def _auto_start_str(self, channel):
         '''
         returns